@@ -0,0 +1,64 @@
+import collections
+import tempfile
+import threading
+from protocol import BinaryCodec
+
+# Finished games, taken out of ChessServer.games once nobody is attached to them any more.
+# Each is kept as its final snapshot in the binary wire format, a few dozen bytes plus two
+# per move. The most recently finished or viewed ones stay in memory, the rest are appended
+# to a spill file and read back when a late spectator asks for them. The spill file is
+# anonymous and goes away with the process: GameStore is what makes games durable.
+
+ARCHIVE_MEMORY = 10000  # Finished games kept in memory, older ones are on disk
+
+
+class GameArchive:
+    def __init__(self, capacity=ARCHIVE_MEMORY, directory=None):
+        self.capacity = capacity
+        self.directory = directory  # Where the spill file is created, the system's temp dir by default
+        self.codec = BinaryCodec()
+        self.records = collections.OrderedDict()  # game_id: encoded snapshot, least recently used first
+        self.offsets = {}  # game_id: (offset, length) of its snapshot in the spill file
+        self.file = None  # Spill file, created on the first spill
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records.keys() | self.offsets.keys())
+
+    def add(self, game_id, state):
+        record = self.codec.encode({"action": "update", "state": state})
+        with self.lock:
+            self.records[game_id] = record
+            self.offsets.pop(game_id, None)
+            self.trim()
+
+    def trim(self):
+        # Spills the least recently used records, each is written at most once
+        while len(self.records) > self.capacity:
+            game_id, record = self.records.popitem(last=False)
+            if game_id not in self.offsets:
+                if self.file is None:
+                    self.file = tempfile.TemporaryFile(prefix="chess-archive-", dir=self.directory)
+                offset = self.file.seek(0, 2)
+                self.file.write(record)
+                self.offsets[game_id] = (offset, len(record))
+
+    def get(self, game_id):
+        # The game's final state, or None if it was never archived
+        with self.lock:
+            record = self.records.get(game_id)
+            if record is not None:
+                self.records.move_to_end(game_id)
+            elif game_id in self.offsets:
+                offset, length = self.offsets[game_id]
+                self.file.seek(offset)
+                record = self.records[game_id] = self.file.read(length)
+                self.trim()
+            else:
+                return None
+        message, = self.codec.decoder(record).feed(b"")
+        return message["state"]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
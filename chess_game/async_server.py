@@ -0,0 +1,199 @@
+import asyncio
+import json
+import time
+from server import ChessServer, PING_INTERVAL, log
+from protocol import JSON
+from connection import OutboundQueue, SlowConsumerError, EVICT_AFTER
+from matchmaking import PAIRING_INTERVAL
+
+TRANSPORT_BUFFER = 64 * 1024  # Bytes written straight to a transport before frames start queueing
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+class StreamClient(OutboundQueue):
+    # Socket-like wrapper around an asyncio StreamWriter so the lobby, broadcast and
+    # reconnect bookkeeping in ChessServer can be shared by both server modes. Frames go
+    # straight to the transport while its buffer is small, once the peer falls behind they
+    # wait in the bounded OutboundQueue and a flush task hands them over as it drains.
+    def __init__(self, writer):
+        super().__init__()
+        self.writer = writer
+        self.codec = JSON  # Wire format, may be switched by the client's initial message
+        self.flushing = False
+
+    def send(self, data):
+        transport = self.writer.transport
+        if transport.is_closing():
+            raise ConnectionError("Connection closed")
+        if not self.queue and transport.get_write_buffer_size() < TRANSPORT_BUFFER:
+            self.writer.write(data)
+            self.stats["frames"] += 1
+            self.stats["bytes"] += len(data)
+            return len(data)
+        try:
+            sent = self.push(data)
+        except SlowConsumerError:
+            self.queue.clear()
+            transport.abort()
+            raise
+        if not self.flushing:
+            self.flushing = True
+            asyncio.get_running_loop().create_task(self.flush())
+        return sent
+
+    async def flush(self):
+        try:
+            while self.queue:
+                await self.writer.drain()
+                self.writer.writelines(self.take())
+            self.drained()
+        except Exception:
+            self.queue.clear()  # The connection is gone, its reader cleans up
+        finally:
+            self.flushing = False
+
+    @property
+    def closed(self):
+        # Same check ClientConnection.closed answers for the threaded server
+        return self.writer.transport.is_closing()
+
+    def close(self):
+        if self.queue:
+            # Whatever is still queued goes out first, like the threaded server's writer
+            self.writer.writelines(self.take())
+        self.writer.close()
+
+
+def raise_fd_limit():
+    # Every connection needs a file descriptor, the default soft limit (often 1024) is too low
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            log.warning("Could not raise open file limit: %s", e)
+
+
+class AsyncChessServer(ChessServer):
+    def __init__(self, host='0.0.0.0', port=5555, backlog=4096, time_control=None, store=None, high_water=None, evict_after=EVICT_AFTER,
+                 metrics_port=None, pools=None):
+        super().__init__(host, port, time_control, store, high_water, evict_after, metrics_port, pools)
+        self.backlog = backlog
+        self.clock_wakeup = None  # asyncio.Event, created once the event loop is running
+
+    def schedule_flag(self, game_id):
+        super().schedule_flag(game_id)
+        if self.clock_wakeup is not None:
+            self.clock_wakeup.set()
+
+    async def clock_loop(self):
+        # Same timer heap as the threaded server, driven from the event loop instead of a thread
+        while True:
+            deadline = self.timers.next_deadline()
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                await asyncio.wait_for(self.clock_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.clock_wakeup.clear()
+            for game_id in self.timers.pop_due(time.monotonic()):
+                self.flag_expired(game_id)
+
+    async def matchmaking_loop(self):
+        while True:
+            await asyncio.sleep(PAIRING_INTERVAL)
+            try:
+                self.pair_players()
+            except Exception:
+                log.exception("Matchmaking tick failed")  # The next tick tries again
+
+    async def ping_loop(self):
+        while True:
+            await asyncio.sleep(PING_INTERVAL)
+            self.send_pings()
+            self.send_pending_snapshots()
+            self.archive_finished_games()
+
+    async def read_messages(self, reader, decoder):
+        for message in decoder.feed(b""):
+            yield message
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            self.bytes_in.inc(len(data))
+            for message in decoder.feed(data):
+                yield message
+
+    async def serve_client(self, reader, writer):
+        client = StreamClient(writer)
+        addr = writer.get_extra_info("peername")
+        try:
+            # The initial JSON line may switch the codec, the stream reader keeps whatever follows it
+            initial_message = json.loads(await reader.readline())
+            client.codec = self.select_codec(initial_message)
+            decoder = client.codec.decoder()
+            client_type = initial_message.get("type", "player")
+            self.register_client(client, client_type, addr)
+
+            if client_type == "player":
+                await self.serve_player(client, reader, decoder, initial_message)
+            else:
+                await self.serve_spectator(client, reader, decoder)
+        except Exception as e:
+            log.info("Error with client %s: %s", addr, e)
+        finally:
+            if client in self.clients:
+                self.disconnect_client(client)
+            else:
+                writer.close()  # Gone or rejected before registering
+
+    async def serve_player(self, client, reader, decoder, initial_message):
+        self.enter_game(client, initial_message)
+        async for message in self.read_messages(reader, decoder):
+            self.process_player_message(client, message)
+
+    async def serve_spectator(self, client, reader, decoder):
+        self.send_game_list(client)
+        await self.spectate(client, self.read_messages(reader, decoder))
+
+    async def spectate(self, client, messages):
+        # The spectator's first message picks the game to watch
+        message = await messages.__anext__()
+        game_id = message.get("game_id")
+        if self.join_spectator(client, game_id):
+            async for message in messages:
+                self.process_spectator_message(client, game_id, message)
+
+    async def accept_connections(self):
+        server = await asyncio.start_server(self.serve_client, self.host, self.port, backlog=self.backlog)
+        log.info("Server started on port %d (asyncio)...", self.port)
+        async with server:
+            await server.serve_forever()
+
+    async def serve(self):
+        raise_fd_limit()
+        self.clock_wakeup = asyncio.Event()
+        self.start_metrics()
+        self.recover_games()
+        clock_task = asyncio.create_task(self.clock_loop())
+        ping_task = asyncio.create_task(self.ping_loop())
+        matchmaking_task = asyncio.create_task(self.matchmaking_loop())
+        try:
+            await self.accept_connections()
+        finally:
+            clock_task.cancel()
+            ping_task.cancel()
+            matchmaking_task.cancel()
+            self.archive.close()
+            if self.store is not None:
+                self.store.close()
+
+    def run(self):
+        asyncio.run(self.serve())
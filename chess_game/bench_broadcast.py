@@ -0,0 +1,58 @@
+import argparse
+import time
+from bench_locking import FakeClient
+from server import ChessServer
+
+# Cost of one broadcast for a game with a fixed audience while the number of other
+# connected clients on the server grows. With the per-game audience index the cost
+# should only depend on --spectators, not on --background.
+#
+#   python bench_broadcast.py --spectators 10 --background 0 1000 10000 100000
+
+
+def setup(spectators, background):
+    server = ChessServer()
+
+    def connect(client_type):
+        client = FakeClient()
+        server.register_client(client, client_type, ("bench", 0))
+        return client
+
+    players = connect("player"), connect("player")
+    with server.lock:
+        server.start_game(*players)
+    game_id = server.game_counter
+    for _ in range(spectators):
+        server.join_spectator(connect("spectator"), game_id)
+
+    # Everyone else watches a handful of other games
+    for _ in range(10):
+        players = connect("player"), connect("player")
+        with server.lock:
+            server.start_game(*players)
+    for i in range(background):
+        server.join_spectator(connect("spectator"), game_id + 1 + i % 10)
+    return server, game_id
+
+
+def run(spectators, background, iterations):
+    server, game_id = setup(spectators, background)
+    lock = server.game_locks[game_id]
+    start = time.perf_counter()
+    for _ in range(iterations):
+        with lock:
+            server.broadcast_delta(game_id)
+    return (time.perf_counter() - start) / iterations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Broadcast cost vs. number of unrelated clients")
+    parser.add_argument("--spectators", type=int, default=10, help="Spectators of the benchmarked game")
+    parser.add_argument("--background", type=int, nargs="+", default=[0, 1000, 10000, 100000], help="Clients watching other games")
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'clients':>8} {'us/broadcast':>13}")
+    for background in args.background:
+        cost = run(args.spectators, background, args.iterations)
+        print(f"{background + args.spectators + 22:>8} {cost * 1e6:>13.1f}")
@@ -0,0 +1,151 @@
+import argparse
+import contextlib
+import io
+import os
+import random
+import socket
+import threading
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")  # No window needed, the drawing work is the same
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import chess
+import pygame
+from client import ChessClient
+
+# Frame time and CPU use of the pygame client following a game, with the full redraw at 60 FPS
+# it used to do against the retained renderer that sleeps until something changes. A fake
+# server in this process feeds the client a move every --move-every seconds over a real socket.
+#
+#   python bench_client.py --seconds 10 --move-every 1
+#   python bench_client.py --seconds 10 --move-every 1000    # an idle spectator
+
+
+def legacy_frame(client):
+    # What ChessClient drew every frame before retained rendering, new fonts included
+    screen = client.screen
+    state = client.state
+    square_size = 50
+    screen.blit(client.background, (0, 0))
+    for row in range(8):
+        for col in range(8):
+            color = (181, 136, 99) if (row + col) % 2 == 0 else (240, 217, 181)
+            pygame.draw.rect(screen, color, (col * square_size, row * square_size, square_size, square_size))
+            piece = state.board.piece_at(chess.square(col, 7 - row))
+            if piece:
+                key = f"{'w' if piece.color == chess.WHITE else 'b'}{piece.symbol().lower()}"
+                if key in client.piece_images:
+                    screen.blit(client.piece_images[key], (col * square_size, row * square_size))
+            font = pygame.font.Font(None, 20)
+            if row == 7:
+                screen.blit(font.render(chr(97 + col), True, (0, 0, 0)), (col * square_size + 20, 7 * square_size + 5))
+            if col == 0:
+                screen.blit(font.render(str(8 - row), True, (0, 0, 0)), (5, row * square_size + 20))
+    font = pygame.font.Font(None, 20)
+    pygame.draw.rect(screen, (255, 255, 255, 200), pygame.Rect(420, 100, 350, 200))
+    y = 110
+    for msg in list(client.chat_messages)[-6:]:
+        screen.blit(font.render(msg, True, (0, 0, 0)), (430, y))
+        y += 20
+    pygame.draw.rect(screen, (255, 255, 255), pygame.Rect(420, 300, 350, 30))
+    screen.blit(font.render(f"> {client.input_text}", True, (0, 0, 0)), (430, 305))
+    font = pygame.font.Font(None, 28)
+    white_time, black_time = client.clock_values(state)
+    screen.blit(font.render(f"White: {client.format_clock(white_time)}", True, (255, 255, 255)), (420, 340))
+    screen.blit(font.render(f"Black: {client.format_clock(black_time)}", True, (255, 255, 255)), (420, 370))
+    font = pygame.font.Font(None, 24)
+    screen.blit(font.render("Spectator Mode", True, (255, 255, 255)), (420, 90))
+    pygame.display.flip()
+
+
+def feed(server, client_codec, move_every, stop):
+    # Plays a random game towards the client: a snapshot, then a delta (and a chat line) per move
+    connection, _ = server.accept()
+    with connection:
+        connection.recv(4096)  # Initial message
+        board = chess.Board()
+        rng = random.Random(1)
+        clocks = {chess.WHITE: 600.0, chess.BLACK: 600.0}
+        state = {"seq": 0, "fen": board.fen(), "turn": "white", "white_time": 600.0, "black_time": 600.0,
+                 "increment": 0, "delay": 0, "move_history": [], "is_checkmate": False, "is_stalemate": False,
+                 "flagged": None, "is_game_over": False}
+        connection.sendall(client_codec.encode({"action": "update", "state": state}))
+        while not stop.wait(move_every):
+            if board.is_game_over():
+                board.reset()
+                connection.sendall(client_codec.encode({"action": "update", "state": dict(state, seq=board.ply())}))
+                continue
+            clocks[board.turn] -= move_every
+            board.push(rng.choice(list(board.legal_moves)))
+            delta = {"seq": board.ply(), "move": board.peek().uci(), "turn": "white" if board.turn else "black",
+                     "white_time": clocks[chess.WHITE], "black_time": clocks[chess.BLACK]}
+            connection.sendall(client_codec.encode({"action": "delta", "delta": delta}) +
+                               client_codec.encode({"action": "chat", "message": f"move {board.ply()}"}))
+
+
+def measure(loop, seconds, move_every):
+    server = socket.create_server(("127.0.0.1", 0))
+    with contextlib.redirect_stdout(io.StringIO()):  # The client logs every message it receives
+        client = ChessClient(port=server.getsockname()[1], mode="spectator")
+    stop = threading.Event()
+    feeder = threading.Thread(target=feed, args=(server, client.codec, move_every, stop), daemon=True)
+    feeder.start()
+    frame_times = []
+    cpu = time.process_time()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        loop(client, seconds, frame_times)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    stop.set()
+    feeder.join()
+    server.close()
+    return len(frame_times), sum(frame_times) / max(1, len(frame_times)) * 1000, 100 * cpu / elapsed
+
+
+def legacy_loop(client, seconds, frame_times):
+    client.send_hello()
+    threading.Thread(target=client.receive_messages, daemon=True).start()
+    clock = pygame.time.Clock()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pygame.event.get()
+        start = time.perf_counter()
+        legacy_frame(client)
+        frame_times.append(time.perf_counter() - start)
+        clock.tick(60)
+    client.running = False
+    client.client.close()
+    pygame.quit()
+
+
+def retained_loop(client, seconds, frame_times):
+    render = client.render
+
+    def timed_render():
+        start = time.perf_counter()
+        render()
+        frame_times.append(time.perf_counter() - start)
+
+    def stop():
+        client.running = False
+        client.wake()
+
+    client.render = timed_render
+    client.send_initial_message = client.send_hello
+    timer = threading.Timer(seconds, stop)
+    timer.start()
+    client.run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pygame client frame time and CPU use, full redraw vs. retained rendering")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--move-every", type=float, default=1, help="Seconds between moves in the fed game")
+    args = parser.parse_args()
+
+    print(f"{'renderer':>10} {'frames':>7} {'ms/frame':>9} {'CPU %':>6}")
+    for name, loop in (("full 60fps", legacy_loop), ("retained", retained_loop)):
+        frames, frame_ms, cpu = measure(loop, args.seconds, args.move_every)
+        print(f"{name:>10} {frames:>7} {frame_ms:>9.3f} {cpu:>6.1f}")
@@ -0,0 +1,130 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import time
+import chess
+from archive import GameArchive
+from chess_logic import ChessGame, HOT_BOARDS
+
+# Bytes per game held by the server for a large number of live games: the game record as it
+# was (a full chess.Board per game plus the moves again as UCI strings) against the slotted
+# record with packed moves, with and without a full cache of hot boards, and what a finished
+# game costs once archived, in memory and spilled to disk. Every variant is built in a forked
+# child and measured by how much its resident set grows (Linux), allocator overhead included.
+#
+#   python bench_game_memory.py --games 100000 --plies 40
+#
+# 100k legacy records take over 2 GB and a couple of minutes to build.
+
+TIME_CONTROL = {"initial_time": 600, "increment": 0, "delay": 0}
+
+
+class LegacyGame:
+    # The attributes ChessGame had before it was compacted, with the same kinds of values
+    def __init__(self, moves):
+        self.board = chess.Board()
+        self.initial_time, self.increment, self.delay = 600, 0, 0
+        self.white_ms = self.black_ms = 600000
+        self.increment_ms = self.delay_ms = 0
+        self.turn_started = None
+        self.lag_allowance = {chess.WHITE: 0, chess.BLACK: 0}
+        self.flagged = None
+        self.move_history = []
+        for uci_move in moves:
+            self.board.push(chess.Move.from_uci(uci_move))
+            self.move_history.append(uci_move)
+        self.current_turn = self.board.turn
+        self.seq = len(moves)
+        self.checkmate = self.stalemate = self.board_over = False
+        self.cached_fen = None
+
+
+def random_games(count, plies):
+    # Move lists of random games, reused round robin: generating 100k games would take minutes
+    rng = random.Random(1)
+    games = []
+    while len(games) < count:
+        board = chess.Board()
+        while board.ply() < plies and not board.is_game_over():
+            board.push(rng.choice(list(board.legal_moves)))
+        if board.ply() == plies:
+            games.append([move.uci() for move in board.move_stack])
+    return games
+
+
+def fresh(moves):
+    # New string objects, as every game's moves arrive off the wire
+    return json.loads(json.dumps(moves))
+
+
+def resident():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def child(build, count, results):
+    before = resident()
+    start = time.perf_counter()
+    kept = build()
+    elapsed = time.perf_counter() - start
+    results.send(((resident() - before) / count, elapsed))
+    return kept
+
+
+def measure(build, count):
+    # Forked so every variant starts from the same heap and its memory is returned afterwards
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context("fork").Process(target=child, args=(build, count, sender))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def live_games(samples, count):
+    ChessGame.boards.boards.clear()
+    return [ChessGame.restore(TIME_CONTROL, fresh(samples[i % len(samples)])) for i in range(count)]
+
+
+def hot_games(samples, count):
+    # The records, then the boards of the most recently active ones
+    games = live_games(samples, count)
+    for game in games[-ChessGame.boards.capacity:]:
+        game.board
+    return games
+
+
+def archived_games(states, count, capacity):
+    archive = GameArchive(capacity)
+    for game_id in range(count):
+        archive.add(game_id, states[game_id % len(states)])
+    state = archive.get(count - 1)  # From disk when spilled
+    assert state["move_history"] == states[(count - 1) % len(states)]["move_history"]
+    return archive
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory per game, legacy vs. compact game records and the archive")
+    parser.add_argument("--games", type=int, default=100000)
+    parser.add_argument("--plies", type=int, default=40, help="Plies played in every game")
+    parser.add_argument("--distinct", type=int, default=200, help="Different random games the others repeat")
+    parser.add_argument("--hot-boards", type=int, default=HOT_BOARDS, help="Size of the board cache for the hot variant")
+    args = parser.parse_args()
+
+    samples = random_games(args.distinct, args.plies)
+    count = args.games
+    print(f"{count} games of {args.plies} plies")
+    print(f"{'record':>34} {'bytes/game':>11} {'total MB':>9} {'build s':>8}")
+
+    def report(name, per_game, elapsed):
+        print(f"{name:>34} {per_game:>11,.0f} {per_game * count / 2 ** 20:>9.1f} {elapsed:>8.1f}")
+
+    report("dict + chess.Board + UCI list", *measure(lambda: [LegacyGame(fresh(samples[i % len(samples)])) for i in range(count)], count))
+    report("slotted, packed moves", *measure(lambda: live_games(samples, count), count))
+    ChessGame.boards.capacity = args.hot_boards
+    report(f"  + {min(args.hot_boards, count)} hot boards", *measure(lambda: hot_games(samples, count), count))
+    states = [ChessGame.restore(TIME_CONTROL, moves).get_game_state() for moves in samples]
+    report("archived, in memory", *measure(lambda: archived_games(states, count, count), count))
+    report("archived, spilled to disk", *measure(lambda: archived_games(states, count, 0), count))
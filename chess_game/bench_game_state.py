@@ -0,0 +1,118 @@
+import argparse
+import random
+import time
+import chess
+from chess_logic import ChessGame, pack_move
+
+# get_game_state() calls per second with the outcome and FEN cached per position, against the
+# same snapshot built by querying python-chess directly (what get_game_state did before), for
+# positions sampled from random games. Also compares a move followed by its delta.
+#
+#   python bench_game_state.py --games 20 --calls 20000
+
+
+def uncached_remaining_time(game, color, now):
+    stored = (game.white_ms if color == chess.WHITE else game.black_ms) / 1000
+    if color != game.current_turn or game.turn_started is None or game.flagged is not None or game.board.is_game_over():
+        return stored
+    return max(0, stored - max(0, now - game.turn_started / 1000 - game.delay))
+
+
+def uncached_state(game):
+    # The snapshot as it was computed before ChessGame cached the position (clocks in seconds)
+    now = time.monotonic()
+    return {
+        "seq": game.seq,
+        "fen": game.board.fen(),
+        "turn": "white" if game.current_turn == chess.WHITE else "black",
+        "white_time": uncached_remaining_time(game, chess.WHITE, now),
+        "black_time": uncached_remaining_time(game, chess.BLACK, now),
+        "increment": game.increment,
+        "delay": game.delay,
+        "move_history": game.move_history,
+        "is_checkmate": game.board.is_checkmate(),
+        "is_stalemate": game.board.is_stalemate(),
+        "flagged": None if game.flagged is None else ("white" if game.flagged == chess.WHITE else "black"),
+        "is_game_over": game.flagged is not None or game.board.is_game_over()
+    }
+
+
+def uncached_move(game, uci_move):
+    # Validation and push as make_move did them before the cache, then the delta broadcast.
+    # The move is recorded too, so a board evicted from the cache replays to this position.
+    move = chess.Move.from_uci(uci_move)
+    if not game.board.is_game_over() and move in game.board.legal_moves:
+        game.board.push(move)
+        game.moves.append(pack_move(move))
+        game.current_turn = game.board.turn
+    now = time.monotonic()
+    uncached_remaining_time(game, chess.WHITE, now)
+    uncached_remaining_time(game, chess.BLACK, now)
+    if game.board.is_game_over():
+        game.board.is_checkmate()
+        game.board.is_stalemate()
+
+
+def cached_move(game, uci_move):
+    game.make_move(uci_move)
+    game.get_delta()
+
+
+def sample_games(count, max_plies):
+    rng = random.Random(1)
+    games = []
+    for _ in range(count):
+        game = ChessGame()
+        game.start_clock()
+        for _ in range(rng.randrange(max_plies)):
+            if game.is_game_over():
+                break
+            game.make_move(rng.choice(sorted(game.board.legal_moves, key=chess.Move.uci)).uci())
+        games.append(game)
+    return games
+
+
+def rate(function, games, calls):
+    start = time.perf_counter()
+    for i in range(calls):
+        function(games[i % len(games)])
+    return calls / (time.perf_counter() - start)
+
+
+def move_rate(play, plies, settle=False):
+    # Moves/s over whole random games, each move followed by its delta. The cached version
+    # settles the outcome once per push instead of on every is_game_over() call. With settle,
+    # the game's cached outcome is brought up to date after each move, outside the timing.
+    rng = random.Random(2)
+    moves = 0
+    elapsed = 0
+    while moves < plies:
+        game = ChessGame()
+        game.start_clock()
+        while not game.board.is_game_over() and moves < plies:
+            move = rng.choice(sorted(game.board.legal_moves, key=chess.Move.uci)).uci()
+            start = time.perf_counter()
+            play(game, move)
+            elapsed += time.perf_counter() - start
+            moves += 1
+            if settle:
+                game.position_changed(game.board)
+    return moves / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="get_game_state() throughput with and without the per-position cache")
+    parser.add_argument("--games", type=int, default=20, help="Sampled positions")
+    parser.add_argument("--max-plies", type=int, default=120)
+    parser.add_argument("--calls", type=int, default=20000)
+    parser.add_argument("--moves", type=int, default=5000)
+    args = parser.parse_args()
+
+    games = sample_games(args.games, args.max_plies)
+    before = rate(uncached_state, games, args.calls)
+    after = rate(ChessGame.get_game_state, games, args.calls)
+    print(f"get_game_state/s   python-chess queries: {before:>10.0f}   cached: {after:>10.0f}   ({after / before:.1f}x)")
+    print(f"get_delta/s        cached: {rate(ChessGame.get_delta, games, args.calls):>10.0f}")
+    before = move_rate(uncached_move, args.moves, settle=True)
+    after = move_rate(cached_move, args.moves)
+    print(f"move + delta/s     python-chess queries: {before:>10.0f}   cached: {after:>10.0f}   ({after / before:.1f}x)")
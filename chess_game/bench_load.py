@@ -0,0 +1,161 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import time
+from bot import Bot, LoadStats
+from protocol import CODECS
+from server_process import start_server
+
+# End-to-end load test: N games with M spectators each against a local server, played by
+# headless bots as fast as the server answers. Reports moves/s, move-to-broadcast latency
+# percentiles, bytes per game and the server's CPU time and peak RSS (read from /proc, so
+# the server figures need Linux). Starts its own server unless --port points at one.
+#
+#   python bench_load.py --games 50 --spectators 4 --plies 80
+#   python bench_load.py --server-args "--mode asyncio" --protocol binary
+#   python bench_load.py --json > run.json     # for comparing runs in CI
+
+
+def process_tree(pid):
+    # The server and its children, so a sharded server is measured as a whole
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as stat:
+                    ppid = int(stat.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    pids = [pid]
+    for parent in pids:
+        pids.extend(children.get(parent, []))
+    return pids
+
+
+def cpu_seconds(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])  # utime + stime
+        except (OSError, IndexError, ValueError):
+            pass
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+def rss_bytes(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+async def sample_rss(pid, peak):
+    while True:
+        peak[0] = max(peak[0], rss_bytes(process_tree(pid)))
+        await asyncio.sleep(0.2)
+
+
+async def run_game(args, stats, index):
+    rng = random.Random(index)
+    white = Bot(args.host, args.port, args.protocol, stats, rng)
+    black = Bot(args.host, args.port, args.protocol, stats, rng)
+    # Connected one after the other so the lobby pairs these two bots together
+    white_game = asyncio.create_task(white.play(max_plies=args.plies, chat_every=args.chat_every))
+    while white.writer is None:
+        await asyncio.sleep(0.001)
+    await asyncio.sleep(0.01)
+    black_game = asyncio.create_task(black.play(max_plies=args.plies, chat_every=args.chat_every))
+    while white.game_id is None and not white_game.done():
+        await asyncio.sleep(0.005)
+    spectators = [asyncio.create_task(Bot(args.host, args.port, args.protocol, stats, rng).spectate(white.game_id))
+                  for _ in range(args.spectators)]
+    await asyncio.gather(white_game, black_game)
+    for spectator in spectators:
+        spectator.cancel()
+
+
+async def run(args, server_pid):
+    stats = LoadStats()
+    peak = [0]
+    sampler = asyncio.create_task(sample_rss(server_pid, peak)) if server_pid else None
+    cpu_before = cpu_seconds(process_tree(server_pid)) if server_pid else None
+    start = time.perf_counter()
+    # Games are started a few at a time so concurrently connecting pairs are not crossed by the lobby
+    games = []
+    for index in range(args.games):
+        games.append(asyncio.create_task(run_game(args, stats, index)))
+        await asyncio.sleep(0.02)
+    await asyncio.gather(*games, return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    result = {
+        "games": args.games,
+        "spectators_per_game": args.spectators,
+        "moves": stats.moves,
+        "seconds": elapsed,
+        "moves_per_second": stats.moves / elapsed,
+        "latency_ms": {name: None if stats.percentile(fraction) is None else stats.percentile(fraction) * 1000
+                       for name, fraction in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999))},
+        "bytes_to_clients_per_game": stats.bytes_received / args.games,
+        "bytes_from_clients_per_game": stats.bytes_sent / args.games,
+    }
+    if server_pid:
+        sampler.cancel()
+        result["server_cpu_seconds"] = cpu_seconds(process_tree(server_pid)) - cpu_before
+        result["server_cpu_percent"] = 100 * result["server_cpu_seconds"] / elapsed
+        result["server_peak_rss_mb"] = peak[0] / 2 ** 20
+    return result
+
+
+def report(result):
+    latency = result["latency_ms"]
+    print(f"games: {result['games']} x {result['spectators_per_game']} spectators, "
+          f"{result['moves']} moves in {result['seconds']:.2f}s = {result['moves_per_second']:.0f} moves/s")
+    if latency["p50"] is not None:
+        print(f"move-to-broadcast latency: p50 {latency['p50']:.2f} ms, p99 {latency['p99']:.2f} ms, p999 {latency['p999']:.2f} ms")
+    print(f"bytes per game: {result['bytes_to_clients_per_game']:.0f} to clients, {result['bytes_from_clients_per_game']:.0f} from clients")
+    if "server_cpu_seconds" in result:
+        print(f"server: {result['server_cpu_seconds']:.2f} CPU s ({result['server_cpu_percent']:.0f}%), "
+              f"peak RSS {result['server_peak_rss_mb']:.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Moves/s, latency and server cost under N games with M spectators")
+    parser.add_argument("--games", type=int, default=50)
+    parser.add_argument("--spectators", type=int, default=4, help="Spectators per game")
+    parser.add_argument("--plies", type=int, default=80, help="Plies per game (games that end sooner stop there)")
+    parser.add_argument("--chat-every", type=int, default=0, help="Players chat every N moves (0 = never)")
+    parser.add_argument("--protocol", choices=list(CODECS), default="json")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="Use a running server instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="PID of the running server, for its CPU and RSS")
+    parser.add_argument("--server-args", default="", help="Extra arguments for the server this benchmark starts")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    server = None
+    server_pid = args.server_pid
+    if args.port is None:
+        server, args.port = start_server("--time", str(10 ** 6), *shlex.split(args.server_args))
+        server_pid = server.pid
+    try:
+        result = asyncio.run(run(args, server_pid))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        report(result)
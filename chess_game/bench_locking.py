@@ -0,0 +1,89 @@
+import argparse
+import random
+import threading
+import time
+import chess
+from chess_logic import ChessGame
+from protocol import JSON
+from server import ChessServer
+
+# Move throughput against the number of concurrent games, one thread driving each game
+# through ChessServer.process_player_message. Run with --shared-lock to put every game
+# behind one lock again, which is how the server behaved before per-game locks.
+#
+#   python bench_locking.py --games 1 2 4 8 16 32 --seconds 3
+
+
+class FakeClient:
+    codec = JSON
+    needs_snapshot = False
+
+    def __init__(self):
+        self.bytes_sent = 0
+
+    def send(self, data):
+        self.bytes_sent += len(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def setup(num_games, shared_lock):
+    server = ChessServer(time_control={"initial_time": 10 ** 9, "increment": 0, "delay": 0})
+    players = []
+    for _ in range(num_games):
+        white, black = FakeClient(), FakeClient()
+        for client in (white, black):
+            server.register_client(client, "player", ("bench", 0))
+        with server.lock:
+            server.start_game(white, black)
+        players.append((white, black))
+    if shared_lock:
+        lock = threading.Lock()
+        for game_id in server.game_locks:
+            server.game_locks[game_id] = lock
+    return server, players
+
+
+def play(server, game_id, white, black, deadline, counts, index):
+    rng = random.Random(game_id)
+    moves = 0
+    while time.perf_counter() < deadline:
+        game = server.games[game_id]
+        if game.board.is_game_over():
+            with server.game_locks[game_id]:
+                server.games[game_id] = ChessGame(**server.time_control)
+            continue
+        move = rng.choice(list(game.board.legal_moves)).uci()
+        player = white if game.board.turn == chess.WHITE else black
+        server.process_player_message(player, {"action": "move", "move": move, "game_id": game_id})
+        moves += 1
+    counts[index] = moves
+
+
+def run(num_games, seconds, shared_lock):
+    server, players = setup(num_games, shared_lock)
+    counts = [0] * num_games
+    deadline = time.perf_counter() + seconds
+    threads = [threading.Thread(target=play, args=(server, game_id, white, black, deadline, counts, i))
+               for i, (game_id, (white, black)) in enumerate(zip(sorted(server.games), players))]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move throughput vs. number of concurrent games")
+    parser.add_argument("--games", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--shared-lock", action="store_true", help="Use one lock for every game (old behaviour)")
+    args = parser.parse_args()
+
+    print(f"{'games':>6} {'moves/s':>10} {'per game':>10}")
+    for num_games in args.games:
+        rate = run(num_games, args.seconds, args.shared_lock)
+        print(f"{num_games:>6} {rate:>10.0f} {rate / num_games:>10.1f}")
@@ -0,0 +1,134 @@
+import argparse
+import random
+import time
+from matchmaking import Matchmaker, DEFAULT_RATING, PAIRING_INTERVAL, parse_time_control
+
+# Matchmaking throughput and fairness with a very large queue, without any networking.
+#
+# burst:  every player joins at once, then pairing ticks run until one player per pool is left
+# cancel: waiting players leave, the matchmaker against the list lobby it replaced
+# unrated: every player joins without a rating, so all share the 1500 point of one bucket
+# steady: players keep arriving at --rate per second of simulated time, ticks run every
+#         PAIRING_INTERVAL of it; waits are simulated seconds, tick times are real ones
+#
+#   python bench_matchmaking.py --players 100000 --rate 2000
+
+
+def ratings(rng, count):
+    return [min(3000, max(100, int(rng.gauss(1500, 350)))) for _ in range(count)]
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def burst(args, pools):
+    rng = random.Random(1)
+    matchmaker = Matchmaker(pools, pools[0])
+    names = list(matchmaker.pools)
+    start = time.perf_counter()
+    for player, rating in enumerate(ratings(rng, args.players)):
+        matchmaker.enqueue(player, rating, rng.choice(names), now=0)
+    enqueued = time.perf_counter() - start
+    start = time.perf_counter()
+    games = len(matchmaker.pair(0))
+    first_tick = time.perf_counter() - start
+    left = len(matchmaker)
+    # The few players the first tick could not fit wait for their windows to widen
+    now = 0
+    while len(matchmaker) > len(names):
+        now += PAIRING_INTERVAL
+        games += len(matchmaker.pair(now))
+    print(f"burst: {args.players} players queued in {enqueued * 1000:.0f} ms ({args.players / enqueued:,.0f}/s), "
+          f"first tick paired {args.players - left} in {first_tick * 1000:.0f} ms ({(args.players - left) / first_tick:,.0f}/s)")
+    print(f"       the other {left} were paired within {now:.1f}s as their windows widened, {games} games")
+
+
+def cancel(args, pools):
+    rng = random.Random(2)
+    players = list(range(args.players))
+    leaving = rng.sample(players, args.cancels)
+    matchmaker = Matchmaker(pools, pools[0])
+    for player, rating in zip(players, ratings(rng, args.players)):
+        matchmaker.enqueue(player, rating)
+    start = time.perf_counter()
+    for player in leaving:
+        matchmaker.cancel(player)
+    matchmaker_time = time.perf_counter() - start
+    lobby = list(players)
+    start = time.perf_counter()
+    for player in leaving:
+        if player in lobby:
+            lobby.remove(player)
+    list_time = time.perf_counter() - start
+    print(f"cancel: {args.cancels} of {args.players} waiting players leave: matchmaker {matchmaker_time * 1000:.1f} ms, "
+          f"list lobby {list_time * 1000:.0f} ms")
+
+
+def unrated(args, pools):
+    # Joining and leaving must not slow down with the number of players on one rating
+    rng = random.Random(4)
+    matchmaker = Matchmaker(pools, pools[0])
+    start = time.perf_counter()
+    for player in range(args.players):
+        matchmaker.enqueue(player, now=0)
+    enqueued = time.perf_counter() - start
+    start = time.perf_counter()
+    for player in rng.sample(range(args.players), args.cancels):
+        matchmaker.cancel(player)
+    cancelled = time.perf_counter() - start
+    start = time.perf_counter()
+    games = len(matchmaker.pair(0))
+    paired = time.perf_counter() - start
+    print(f"unrated: {args.players} players at {DEFAULT_RATING} queued in {enqueued * 1000:.0f} ms "
+          f"({enqueued / args.players * 1e6:.2f} us each), {args.cancels} left in {cancelled * 1000:.1f} ms "
+          f"({cancelled / args.cancels * 1e6:.2f} us each), {games} games paired in {paired * 1000:.0f} ms")
+
+
+def steady(args, pools):
+    rng = random.Random(3)
+    matchmaker = Matchmaker(pools, pools[0])
+    names = list(matchmaker.pools)
+    player_ratings = ratings(rng, args.players)
+    arrivals = sorted(rng.uniform(0, args.players / args.rate) for _ in range(args.players))
+    waits = []
+    gaps = []
+    ticks = []
+    joined = 0
+    now = 0
+    while joined < args.players or len(matchmaker) > 1:
+        now += PAIRING_INTERVAL
+        while joined < args.players and arrivals[joined] <= now:
+            matchmaker.enqueue(joined, player_ratings[joined], rng.choice(names), now=arrivals[joined])
+            joined += 1
+        start = time.perf_counter()
+        pairs = matchmaker.pair(now)
+        ticks.append(time.perf_counter() - start)
+        for first, second in pairs:
+            waits += [now - first["since"], now - second["since"]]
+            gaps.append(abs(first["rating"] - second["rating"]))
+        if joined == args.players and not pairs and len(matchmaker) <= len(names):
+            break  # At most one player left over per pool
+    print(f"steady: {args.rate}/s for {args.players / args.rate:.0f}s simulated, {len(gaps)} games, "
+          f"tick mean {sum(ticks) / len(ticks) * 1000:.2f} ms max {max(ticks) * 1000:.1f} ms")
+    print(f"        wait p50 {percentile(waits, 0.5):.2f}s p90 {percentile(waits, 0.9):.2f}s "
+          f"p99 {percentile(waits, 0.99):.2f}s max {max(waits):.2f}s, "
+          f"rating gap p50 {percentile(gaps, 0.5)} p99 {percentile(gaps, 0.99)} max {max(gaps)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Matchmaking throughput and wait times with a large queue")
+    parser.add_argument("--players", type=int, default=100000)
+    parser.add_argument("--cancels", type=int, default=10000, help="Waiting players who leave in the cancel test")
+    parser.add_argument("--rate", type=float, default=2000, help="Players arriving per simulated second in the steady test")
+    parser.add_argument("--pools", nargs="+", default=["600+0", "180+2", "60+0"], help="Time controls, players pick one at random")
+    args = parser.parse_args()
+
+    pools = [parse_time_control(name) for name in args.pools]
+    burst(args, pools)
+    cancel(args, pools)
+    unrated(args, pools)
+    steady(args, pools)
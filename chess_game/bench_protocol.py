@@ -0,0 +1,62 @@
+import argparse
+import random
+import time
+from chess_logic import ChessGame
+from protocol import CODECS
+
+# Encode/decode throughput and bytes on the wire for each codec, using the messages the
+# server actually sends. Decoding feeds a burst of frames in 1 KiB chunks, like recv() does.
+#
+#   python bench_protocol.py --moves 40
+
+
+def sample_messages(moves):
+    game = ChessGame()
+    game.start_clock()
+    rng = random.Random(1)
+    for _ in range(moves):
+        if game.board.is_game_over():
+            break
+        game.make_move(rng.choice(list(game.board.legal_moves)).uci())
+    return {
+        "delta": {"action": "delta", "delta": game.get_delta()},
+        "snapshot": {"action": "update", "state": game.get_game_state()},
+        "move": {"action": "move", "move": game.move_history[-1], "game_id": 1234},
+        "chat": {"action": "chat", "message": "good luck, have fun ♟"},
+    }
+
+
+def measure(function, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return iterations / (time.perf_counter() - start)
+
+
+def bench(codec, message, iterations, burst):
+    frame = codec.encode(message)
+    stream = frame * burst
+    chunks = [stream[i:i + 1024] for i in range(0, len(stream), 1024)]
+
+    def decode():
+        decoder = codec.decoder()
+        for chunk in chunks:
+            decoder.feed(chunk)
+
+    encode_rate = measure(lambda: codec.encode(message), iterations)
+    decode_rate = measure(decode, max(1, iterations // burst)) * burst
+    return len(frame), encode_rate, decode_rate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="JSON lines vs. binary framing")
+    parser.add_argument("--moves", type=int, default=40, help="Moves played before taking the sample messages")
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--burst", type=int, default=100, help="Frames per decoded burst")
+    args = parser.parse_args()
+
+    print(f"{'message':>9} {'codec':>7} {'bytes':>7} {'encode/s':>10} {'decode/s':>10}")
+    for name, message in sample_messages(args.moves).items():
+        for codec in CODECS.values():
+            size, encode_rate, decode_rate = bench(codec, message, args.iterations, args.burst)
+            print(f"{name:>9} {codec.name:>7} {size:>7} {encode_rate:>10.0f} {decode_rate:>10.0f}")
@@ -0,0 +1,62 @@
+import argparse
+import random
+import shutil
+import tempfile
+import time
+from chess_logic import ChessGame
+from store import GameStore
+
+# Recovery time against the number of persisted games, and what persisting costs a move.
+# Every game is played through a GameStore in a temporary directory, the store is closed
+# (as on shutdown) and a fresh one rebuilds every game from its snapshot and log.
+#
+#   python bench_recovery.py --games 100 1000 5000 --moves 40
+
+
+def populate(directory, num_games, moves, snapshot_every):
+    store = GameStore(directory, snapshot_every)
+    rng = random.Random(num_games)
+    append_times = []
+    for game_id in range(1, num_games + 1):
+        game = ChessGame()
+        store.create_game(game_id, {"initial_time": 600, "increment": 0, "delay": 0})
+        game.start_clock()
+        for _ in range(moves):
+            if game.board.is_game_over():
+                break
+            game.make_move(rng.choice(list(game.board.legal_moves)).uci())
+            start = time.perf_counter()
+            store.append_move(game_id, game)
+            append_times.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    store.close()
+    flush_time = time.perf_counter() - start
+    append_times.sort()
+    return append_times, flush_time
+
+
+def run(num_games, moves, snapshot_every):
+    directory = tempfile.mkdtemp(prefix="chess_store_")
+    try:
+        append_times, flush_time = populate(directory, num_games, moves, snapshot_every)
+        start = time.perf_counter()
+        games = GameStore(directory).load()
+        recovery_time = time.perf_counter() - start
+        assert len(games) == num_games
+        p99 = append_times[int(len(append_times) * 0.99)]
+        return recovery_time, p99, flush_time
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Game store recovery time vs. number of games")
+    parser.add_argument("--games", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--moves", type=int, default=40, help="Moves played in every game")
+    parser.add_argument("--snapshot-every", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'games':>6} {'recovery s':>11} {'per game ms':>12} {'append p99 us':>14} {'drain s':>8}")
+    for num_games in args.games:
+        recovery_time, p99, flush_time = run(num_games, args.moves, args.snapshot_every)
+        print(f"{num_games:>6} {recovery_time:>11.3f} {recovery_time / num_games * 1000:>12.3f} {p99 * 1e6:>14.1f} {flush_time:>8.2f}")
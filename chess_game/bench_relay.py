@@ -0,0 +1,89 @@
+import argparse
+import asyncio
+import os
+from bot import Bot, LoadStats
+from protocol import CODECS
+from server_process import start_server
+
+# Move-to-broadcast latency of one game watched by many spectators, with every spectator on the
+# game server against the same audience spread over relays (server.py --relay). The players'
+# latency is what the relays are meant to protect; the spectators' shows what the extra hop costs.
+# Latencies are only counted once every spectator has joined.
+#
+#   python bench_relay.py --spectators 2000 --relays 0 4 --plies 200 --think-time 0.05
+#
+# The spectators run in this process, give it a core of its own for meaningful numbers.
+
+
+class Spectator(Bot):
+    joined = False
+
+    def handle_message(self, message):
+        if message.get("action") == "update":
+            self.joined = True
+        super().handle_message(message)
+
+
+async def watch(args, port, relay_ports):
+    player_stats = LoadStats()
+    spectator_stats = LoadStats()
+    spectator_stats.sent_at = player_stats.sent_at  # Moves are stamped by the players
+    white = Bot("127.0.0.1", port, args.protocol, player_stats)
+    black = Bot("127.0.0.1", port, args.protocol, player_stats)
+    game = [asyncio.create_task(white.play(max_plies=args.plies, think_time=args.think_time))]
+    while white.game_id is None:
+        await asyncio.sleep(0.01)
+        if white.writer is not None and len(game) == 1:
+            game.append(asyncio.create_task(black.play(max_plies=args.plies, think_time=args.think_time)))
+    ports = relay_ports or [port]
+    spectators = [Spectator("127.0.0.1", ports[i % len(ports)], args.protocol, spectator_stats) for i in range(args.spectators)]
+    watching = []
+    for start in range(0, len(spectators), 100):
+        watching += [asyncio.create_task(spectator.spectate(white.game_id)) for spectator in spectators[start:start + 100]]
+        await asyncio.sleep(0.05)
+    while not all(spectator.joined for spectator in spectators) and not game[0].done():
+        await asyncio.sleep(0.05)
+    player_stats.latencies.clear()
+    spectator_stats.latencies.clear()
+    await asyncio.gather(*game)
+    for task in watching:
+        task.cancel()
+    return player_stats, spectator_stats
+
+
+def run(args, relays):
+    server, port = start_server("--mode", "asyncio", "--time", str(10 ** 6))
+    processes = [server]
+    try:
+        relay_ports = []
+        for _ in range(relays):
+            relay, relay_port = start_server("--relay", f"127.0.0.1:{port}")
+            processes.append(relay)
+            relay_ports.append(relay_port)
+        return asyncio.run(watch(args, port, relay_ports))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+def milliseconds(stats, fraction):
+    value = stats.percentile(fraction)
+    return float("nan") if value is None else value * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Player and spectator latency, spectators direct vs. through relays")
+    parser.add_argument("--spectators", type=int, default=2000)
+    parser.add_argument("--relays", type=int, nargs="+", default=[0, 2], help="Relay counts to compare (0 = spectators on the game server)")
+    parser.add_argument("--plies", type=int, default=200)
+    parser.add_argument("--think-time", type=float, default=0.05, help="Seconds each player waits before moving")
+    parser.add_argument("--protocol", choices=list(CODECS), default="binary")
+    args = parser.parse_args()
+
+    print(f"cores: {os.cpu_count()}, {args.spectators} spectators on one game")
+    print(f"{'relays':>6} {'player p50':>11} {'player p99':>11} {'spectator p50':>14} {'spectator p99':>14} {'moves':>6}")
+    for relays in args.relays:
+        players, spectators = run(args, relays)
+        print(f"{relays:>6} {milliseconds(players, 0.5):>9.2f}ms {milliseconds(players, 0.99):>9.2f}ms "
+              f"{milliseconds(spectators, 0.5):>12.2f}ms {milliseconds(spectators, 0.99):>12.2f}ms {len(players.latencies) // 2:>6}")
@@ -0,0 +1,68 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+from bot import Bot, LoadStats
+from protocol import CODECS
+from server_process import start_server
+
+# Move throughput of a sharded server against the number of shards. For every shard count a
+# server is started with --shards N and driven by load-generator processes, each running many
+# players over real sockets. A player answers every position with a random legal move and
+# queues up again when its game ends, so the server never runs out of work.
+#
+#   python bench_shards.py --shards 1 2 4 --games 64 --load-processes 4 --seconds 10
+#
+# The load generators validate moves with python-chess too, so leave them enough cores:
+# shards + load processes should not exceed os.cpu_count().
+
+
+async def player(port, protocol, stats):
+    while True:
+        await Bot("127.0.0.1", port, protocol, stats).play()
+
+
+def load_process(port, protocol, players, seconds, results):
+    async def main():
+        stats = LoadStats()
+        tasks = [asyncio.create_task(player(port, protocol, stats)) for _ in range(players)]
+        await asyncio.wait(tasks, timeout=seconds)
+        for task in tasks:
+            task.cancel()
+        return stats.moves
+    results.put(asyncio.run(main()))
+
+
+def run(shards, games, load_processes, seconds, protocol):
+    server, port = start_server("--shards", str(shards), "--time", str(10 ** 6))
+    try:
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=load_process, args=(port, protocol, 2 * games // load_processes, seconds, results))
+                     for _ in range(load_processes)]
+        for process in processes:
+            process.start()
+        moves = sum(results.get() for _ in processes)
+        for process in processes:
+            process.join()
+        return moves / seconds
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded server move throughput vs. number of shards")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--games", type=int, default=64, help="Concurrent games")
+    parser.add_argument("--load-processes", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--protocol", choices=list(CODECS), default="json")
+    args = parser.parse_args()
+
+    print(f"cores: {os.cpu_count()}")
+    print(f"{'shards':>6} {'moves/s':>10} {'speedup':>8}")
+    baseline = None
+    for shards in args.shards:
+        rate = run(shards, args.games, args.load_processes, args.seconds, args.protocol)
+        baseline = baseline or rate
+        print(f"{shards:>6} {rate:>10.0f} {rate / baseline:>8.2f}")
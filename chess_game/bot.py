@@ -0,0 +1,184 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+import chess
+from protocol import CODECS
+
+# Headless client for load tests: speaks the same protocol as ChessClient without pygame.
+# Players answer every position with a scripted or random legal move, spectators pick a game
+# and follow it, and either can chat. Bots that share a LoadStats measure move-to-broadcast
+# latency: the mover stamps each move when it sends it, every member of the audience
+# (the mover included) records how long the resulting delta took to arrive.
+
+
+class LoadStats:
+    def __init__(self):
+        self.sent_at = {}  # (game_id, ply): time.perf_counter() when the move was sent
+        self.latencies = []  # Seconds from a move being sent to a delta carrying it arriving
+        self.moves = 0  # Moves sent
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.games_started = 0
+        self.games_finished = 0
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Bot:
+    def __init__(self, host='127.0.0.1', port=5555, protocol="json", stats=None, rng=None):
+        self.host = host
+        self.port = port
+        self.codec = CODECS[protocol]
+        self.decoder = self.codec.decoder()
+        self.stats = stats or LoadStats()
+        self.rng = rng or random.Random()
+        self.reader = None
+        self.writer = None
+        self.board = chess.Board()
+        self.color = None
+        self.game_id = None
+        self.game_over = False
+
+    async def connect(self, **hello):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        # The first message on a connection is always a JSON line, it also picks the wire format
+        hello["protocol"] = self.codec.name
+        self.write(json.dumps(hello).encode() + b"\n")
+
+    def write(self, data):
+        self.writer.write(data)
+        self.stats.bytes_sent += len(data)
+
+    def send(self, message):
+        self.write(self.codec.encode(message))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    async def messages(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            self.stats.bytes_received += len(data)
+            for message in self.decoder.feed(data):
+                yield message
+
+    def handle_message(self, message):
+        action = message.get("action")
+        if action in ("start", "reconnected"):
+            self.color = chess.WHITE if message["color"] == "white" else chess.BLACK
+            self.game_id = message["game_id"]
+        elif action == "update":
+            state = message["state"]
+            self.board = chess.Board(state["fen"])
+            self.game_over = state["is_game_over"]
+        elif action == "delta":
+            delta = message["delta"]
+            if delta["move"]:
+                self.board.push_uci(delta["move"])
+                sent_at = self.stats.sent_at.get((self.game_id, self.board.ply()))
+                if sent_at is not None:
+                    self.stats.latencies.append(time.perf_counter() - sent_at)
+            self.game_over = delta.get("is_game_over", False)
+        elif action == "opponent_disconnected":
+            self.game_over = True
+        elif action == "ping":
+            self.send({"action": "pong", "t": message["t"]})
+
+    def choose_move(self, script):
+        ply = self.board.ply()
+        if script and ply < len(script):
+            return script[ply]
+        return self.rng.choice(list(self.board.legal_moves)).uci()
+
+    async def play(self, script=None, max_plies=None, chat_every=0, think_time=0):
+        # Joins the lobby and plays one game, returns once it is over or max_plies were played
+        await self.connect(type="player")
+        started = False
+        try:
+            async for message in self.messages():
+                received = time.perf_counter()
+                self.handle_message(message)
+                if message.get("action") == "start":
+                    started = True
+                    self.stats.games_started += self.color == chess.WHITE
+                if self.game_over or (max_plies is not None and self.board.ply() >= max_plies):
+                    break
+                if message.get("action") == "error":
+                    script = None  # The scripted move was rejected, play on with random moves
+                if started and self.board.turn == self.color and message.get("action") in ("update", "delta", "error"):
+                    if think_time:
+                        await asyncio.sleep(think_time)
+                    move = self.choose_move(script)
+                    self.stats.sent_at[(self.game_id, self.board.ply() + 1)] = time.perf_counter()
+                    self.stats.moves += 1
+                    think_ms = int((time.perf_counter() - received) * 1000)
+                    self.send({"action": "move", "move": move, "game_id": self.game_id, "think_ms": think_ms})
+                    if chat_every and self.stats.moves % chat_every == 0:
+                        self.send({"action": "chat", "message": f"move {self.board.ply() + 1}"})
+            if started and self.color == chess.WHITE:
+                self.stats.games_finished += 1
+        finally:
+            self.close()
+
+    async def spectate(self, game_id=None, chat_every=0):
+        # Watches game_id, or the newest game in the list, until the game ends or the server closes
+        await self.connect(type="spectator")
+        deltas = 0
+        try:
+            async for message in self.messages():
+                if message.get("action") == "game_list":
+                    if game_id is None:
+                        if not message["games"]:
+                            break
+                        game_id = max(message["games"])
+                    self.game_id = game_id
+                    self.send({"game_id": game_id})
+                    continue
+                self.handle_message(message)
+                if self.game_over:
+                    break
+                if message.get("action") == "delta":
+                    deltas += 1
+                    if chat_every and deltas % chat_every == 0:
+                        self.send({"action": "chat", "message": "nice move"})
+        finally:
+            self.close()
+
+
+async def main(args):
+    stats = LoadStats()
+    script = args.script.split(",") if args.script else None
+    if args.mode == "player":
+        bots = [Bot(args.host, args.port, args.protocol, stats).play(script, args.max_plies, args.chat_every, args.think_time)
+                for _ in range(args.count)]
+    else:
+        bots = [Bot(args.host, args.port, args.protocol, stats).spectate(args.game_id, args.chat_every)
+                for _ in range(args.count)]
+    await asyncio.gather(*bots)
+    print(f"Games finished: {stats.games_finished}, moves sent: {stats.moves}, "
+          f"bytes received: {stats.bytes_received}, bytes sent: {stats.bytes_sent}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless chess bots")
+    parser.add_argument("--host", default="127.0.0.1", help="Server address")
+    parser.add_argument("--port", type=int, default=5555, help="Server port")
+    parser.add_argument("--mode", choices=["player", "spectator"], default="player", help="Play games or watch one")
+    parser.add_argument("--count", type=int, default=2, help="Number of bots")
+    parser.add_argument("--protocol", choices=list(CODECS), default="json", help="Wire format after the initial message")
+    parser.add_argument("--script", help="Comma separated UCI moves to play before switching to random moves")
+    parser.add_argument("--max-plies", type=int, help="Leave the game after this many plies")
+    parser.add_argument("--think-time", type=float, default=0, help="Seconds to wait before each move")
+    parser.add_argument("--chat-every", type=int, default=0, help="Send a chat message every N moves (0 = never)")
+    parser.add_argument("--game-id", type=int, help="Game to spectate, the newest one by default")
+    args = parser.parse_args()
+    asyncio.run(main(args))
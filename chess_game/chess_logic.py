@@ -1,40 +1,284 @@
+import array
+import collections
+import threading
 import chess
 import json
+import time
+
+MAX_LAG_COMPENSATION = 1000  # Most network transit a single move can be refunded, in ms
+HOT_BOARDS = 10000  # Games whose chess.Board is kept built, the others replay their moves when next needed
+
+
+def now_ms():
+    # Same clock as time.monotonic(), in integer milliseconds
+    return time.monotonic_ns() // 1000000
+
+
+def pack_move(move):
+    # 16 bits: from square, to square << 6, promotion piece type << 12 (the binary protocol's packing)
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def unpack_move(value):
+    return chess.Move(value & 63, value >> 6 & 63, value >> 12 or None)
+
+
+PROMOTION_SUFFIXES = ("", "", "n", "b", "r", "q")  # By chess piece type
+# UCI of every packed move without a promotion, shared by all games (about 250 KB)
+MOVE_NAMES = tuple(chess.SQUARE_NAMES[value & 63] + chess.SQUARE_NAMES[value >> 6] for value in range(4096))
+MOVE_VALUES = {name: value for value, name in enumerate(MOVE_NAMES)}
+
+
+def packed_uci(value):
+    # Same as unpack_move(value).uci() without building the Move, snapshots list every move
+    return MOVE_NAMES[value & 4095] + PROMOTION_SUFFIXES[value >> 12] if value >> 12 else MOVE_NAMES[value]
+
+
+def pack_uci(uci):
+    # Same as pack_move(chess.Move.from_uci(uci)) without building the Move, for the binary protocol
+    value = MOVE_VALUES[uci[:4]]
+    return value | PROMOTION_SUFFIXES.index(uci[4]) << 12 if len(uci) == 5 else value
+
+
+class BoardCache:
+    # Least recently used chess.Board of the games being played. A board with its move stack
+    # costs kilobytes, a game's packed moves a couple of bytes per ply, so only the games that
+    # moved recently keep one and the rest are rebuilt from their moves on their next move.
+    # Each game's board is only touched under that game's lock, the cache has its own lock.
+    def __init__(self, capacity=HOT_BOARDS):
+        self.capacity = capacity
+        self.boards = collections.OrderedDict()  # ChessGame: chess.Board, least recently used first
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "rebuilds": 0}
+
+    def __len__(self):
+        return len(self.boards)
+
+    def get(self, game):
+        with self.lock:
+            board = self.boards.get(game)
+            if board is not None:
+                self.boards.move_to_end(game)
+                self.stats["hits"] += 1
+                return board
+        board = game.replay()
+        with self.lock:
+            self.stats["rebuilds"] += 1
+            self.boards[game] = board
+            while len(self.boards) > self.capacity:
+                self.boards.popitem(last=False)
+        return board
+
+    def discard(self, game):
+        with self.lock:
+            self.boards.pop(game, None)
+
 
 class ChessGame:
-    def __init__(self):
-        self.board = chess.Board()
-        self.white_time = 600  # 10 minutes in seconds
-        self.black_time = 600
+    # Slotted, and the position is kept as packed moves: the board is built on demand through
+    # the shared BoardCache and the outcome of the current position is cached in three flags.
+    __slots__ = ("initial_time", "increment", "delay", "white_ms", "black_ms", "increment_ms", "delay_ms",
+                 "turn_started", "lag_allowance", "flagged", "current_turn", "moves", "seq",
+                 "checkmate", "stalemate", "board_over", "cached_fen")
+    boards = BoardCache()
+
+    def __init__(self, initial_time=600, increment=0, delay=0):
+        # The time control is given in seconds (10 minutes by default), clocks are kept in integer
+        # milliseconds. white_ms/black_ms are the remaining time at the start of the current turn,
+        # the running clock is never ticked, it is computed from turn_started on demand.
+        self.initial_time = initial_time
+        self.increment = increment  # Added to the mover's clock after every move (Fischer)
+        self.delay = delay  # Grace period at the start of every turn before the clock runs (Bronstein/US delay)
+        self.white_ms = self.black_ms = round(initial_time * 1000)
+        self.increment_ms = round(increment * 1000)
+        self.delay_ms = round(delay * 1000)
+        self.turn_started = None  # now_ms() when the side to move started thinking, None until the clock starts
+        # Network transit a move by each color may be refunded, from that player's measured round
+        # trip time, indexed by color (chess.BLACK == 0, chess.WHITE == 1)
+        self.lag_allowance = [0, 0]
+        self.flagged = None  # Color that ran out of time
         self.current_turn = chess.WHITE
-        self.move_history = []
+        self.moves = array.array("H")  # Every move played, packed with pack_move()
+        self.seq = 0  # Bumped on every state change so clients can detect a missed delta
+        self.checkmate = self.stalemate = self.board_over = False  # Nothing ends a game before the first move
+        self.cached_fen = None
 
-    def make_move(self, uci_move):
+    @property
+    def board(self):
+        return self.boards.get(self)
+
+    @property
+    def move_history(self):
+        # UCI strings, built for snapshots and persistence
+        names = MOVE_NAMES
+        return [names[value] if value < 4096 else packed_uci(value) for value in self.moves]
+
+    def last_move(self):
+        return packed_uci(self.moves[-1]) if self.moves else None
+
+    def replay(self):
+        # The moves were validated when they were played, so they are pushed without checks
+        board = chess.Board()
+        for value in self.moves:
+            board.push(unpack_move(value))
+        return board
+
+    def position_changed(self, board):
+        # Must follow every push (or pop) on the board. The outcome is settled once per position,
+        # stopping at the first legal move, so every state query in between is a lookup. The FEN
+        # is only built when a snapshot first asks for it.
+        has_legal_moves = any(board.generate_legal_moves())
+        check = board.is_check()
+        self.checkmate = check and not has_legal_moves
+        self.stalemate = not check and not has_legal_moves
+        self.board_over = (not has_legal_moves or board.is_insufficient_material() or
+                           board.is_seventyfive_moves() or board.is_fivefold_repetition())
+        self.cached_fen = None
+
+    def fen(self):
+        if self.cached_fen is None:
+            self.cached_fen = self.board.fen()
+        return self.cached_fen
+
+    @classmethod
+    def restore(cls, time_control, moves, white_ms=None, black_ms=None, flagged=None):
+        # Rebuilds a persisted game. The clock stays stopped until start_clock() is called,
+        # so time spent while the server was down is not charged to anyone.
+        game = cls(**time_control)
+        board = chess.Board()
+        for uci_move in moves:
+            move = chess.Move.from_uci(uci_move)
+            board.push(move)
+            game.moves.append(pack_move(move))
+        game.position_changed(board)
+        game.current_turn = board.turn
+        if white_ms is not None:
+            game.white_ms = white_ms
+        if black_ms is not None:
+            game.black_ms = black_ms
+        game.flagged = flagged
+        game.seq = len(moves) + (flagged is not None)
+        return game
+
+    def start_clock(self, now=None):
+        self.turn_started = now_ms() if now is None else now
+
+    def stored_time(self, color):
+        return self.white_ms if color == chess.WHITE else self.black_ms
+
+    def remaining_time(self, color, now=None):
+        # Milliseconds left on color's clock, as a spectator would see it
+        stored = self.stored_time(color)
+        if color != self.current_turn or self.turn_started is None or self.is_game_over():
+            return stored
+        now = now_ms() if now is None else now
+        return max(0, stored - max(0, now - self.turn_started - self.delay_ms))
+
+    def charged_time(self, now, think_ms=None):
+        # What the side to move pays for its turn so far. A move stamped with the client's own
+        # think time is refunded the difference (network transit and server queueing), up to
+        # the player's lag allowance, so a client cannot claim more than its round trip.
+        elapsed = now - self.turn_started
+        if think_ms is not None:
+            elapsed -= min(max(0, elapsed - think_ms), self.lag_allowance[self.current_turn])
+        return max(0, elapsed - self.delay_ms)
+
+    def flag_deadline(self):
+        # Monotonic time (seconds) at which the side to move is out of time even after the
+        # largest refund it could get, None if no clock is running
+        if self.turn_started is None or self.is_game_over():
+            return None
+        deadline = self.turn_started + self.delay_ms + self.stored_time(self.current_turn) + self.lag_allowance[self.current_turn]
+        return deadline / 1000
+
+    def flag(self):
+        if self.current_turn == chess.WHITE:
+            self.white_ms = 0
+        else:
+            self.black_ms = 0
+        self.flagged = self.current_turn
+        self.seq += 1
+
+    def check_flag(self, now=None):
+        # Ends the game if the side to move has run out of time, returns True if it did
+        if self.turn_started is None or self.is_game_over():
+            return False
+        now = now_ms() if now is None else now
+        if now - self.lag_allowance[self.current_turn] - self.turn_started - self.delay_ms < self.stored_time(self.current_turn):
+            return False
+        self.flag()
+        return True
+
+    def is_game_over(self):
+        return self.flagged is not None or self.board_over
+
+    def make_move(self, uci_move, think_ms=None):
+        # think_ms is how long the client says its player thought, from receiving the position
+        # to sending the move, it is ignored unless it is a non-negative integer
         try:
+            if self.is_game_over():
+                return False, "Game over"
+            now = now_ms()
+            if self.check_flag(now):
+                return False, "Out of time"
             move = chess.Move.from_uci(uci_move)
-            if move in self.board.legal_moves:
-                self.board.push(move)
-                self.move_history.append(uci_move)
+            board = self.board
+            if board.is_legal(move):
+                if self.turn_started is not None:
+                    if not isinstance(think_ms, int) or think_ms < 0:
+                        think_ms = None
+                    remaining = self.stored_time(self.current_turn) - self.charged_time(now, think_ms)
+                    if remaining <= 0:
+                        self.flag()
+                        return False, "Out of time"
+                    if self.current_turn == chess.WHITE:
+                        self.white_ms = remaining + self.increment_ms
+                    else:
+                        self.black_ms = remaining + self.increment_ms
+                    self.turn_started = now
+                board.push(move)
+                self.position_changed(board)
+                self.moves.append(pack_move(move))
                 self.current_turn = not self.current_turn
+                self.seq += 1
                 return True, "Valid move"
             return False, "Illegal move"
         except Exception as e:
             return False, f"Error: {str(e)}"
 
     def get_game_state(self):
+        # Clocks go out in seconds, as the time control came in
+        now = now_ms()
         return {
-            "fen": self.board.fen(),
+            "seq": self.seq,
+            "fen": self.fen(),
             "turn": "white" if self.current_turn == chess.WHITE else "black",
-            "white_time": self.white_time,
-            "black_time": self.black_time,
+            "white_time": self.remaining_time(chess.WHITE, now) / 1000,
+            "black_time": self.remaining_time(chess.BLACK, now) / 1000,
+            "increment": self.increment,
+            "delay": self.delay,
             "move_history": self.move_history,
-            "is_checkmate": self.board.is_checkmate(),
-            "is_stalemate": self.board.is_stalemate(),
-            "is_game_over": self.board.is_game_over()
+            "is_checkmate": self.checkmate,
+            "is_stalemate": self.stalemate,
+            "flagged": None if self.flagged is None else ("white" if self.flagged == chess.WHITE else "black"),
+            "is_game_over": self.is_game_over()
         }
 
-    def update_time(self, delta, player_color):
-        if player_color == chess.WHITE:
-            self.white_time = max(0, self.white_time - delta)
-        else:
-            self.black_time = max(0, self.black_time - delta)
\ No newline at end of file
+    def get_delta(self):
+        # Only what changed since the previous seq, the full state is sent on join/reconnect/resync.
+        # "move" is None when the change was a flag fall rather than a move.
+        now = now_ms()
+        delta = {
+            "seq": self.seq,
+            "move": self.last_move() if self.flagged is None else None,
+            "turn": "white" if self.current_turn == chess.WHITE else "black",
+            "white_time": self.remaining_time(chess.WHITE, now) / 1000,
+            "black_time": self.remaining_time(chess.BLACK, now) / 1000
+        }
+        if self.is_game_over():
+            delta["is_checkmate"] = self.checkmate
+            delta["is_stalemate"] = self.stalemate
+            if self.flagged is not None:
+                delta["flagged"] = "white" if self.flagged == chess.WHITE else "black"
+            delta["is_game_over"] = True
+        return delta
@@ -1,5 +1,6 @@
 import socket
 import threading
+import collections
 import json
 import pygame
 import chess
@@ -7,21 +8,60 @@ import sys
 import time
 import os
 import argparse
+from protocol import CODECS
+
+SQUARE_SIZE = 50
+NETWORK_UPDATE = pygame.event.custom_type()  # Posted by the receive thread to wake the render loop
+CHAT_BOX = pygame.Rect(420, 100, 350, 200)
+INPUT_BOX = pygame.Rect(420, 300, 350, 30)
+TIMER_AREA = pygame.Rect(420, 340, 380, 60)
+MAX_CACHED_TEXTS = 512
+CHAT_HISTORY = 50  # Chat lines kept, only the last 6 are shown
+
+# What the renderer draws from the server's messages. The receive thread builds a new one after
+# each batch of messages and publishes it by rebinding ChessClient.state, so the render loop
+# always sees a whole snapshot, and only the newest when several batches arrive within a frame.
+# The board belongs to the snapshot and is never modified after publishing.
+ClientState = collections.namedtuple("ClientState", [
+    "board",  # chess.Board
+    "pieces",  # square: piece symbol
+    "white_time",  # Seconds when the clocks were received, None before the first update
+    "black_time",
+    "received",  # time.monotonic() when the clocks (and the position to move in) arrived
+    "delay",  # Per-move delay in seconds, the running clock only starts after it
+    "rtt",  # Round trip time to the server in ms, as measured by the server's pings
+    "game_over",
+])
 
 class ChessClient:
-    def __init__(self, host='127.0.0.1', port=5555, mode="player"):
+    def __init__(self, host='127.0.0.1', port=5555, mode="player", protocol="json", rating=None, time_control=None):
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.host = host
         self.port = port
         self.mode = mode
+        self.rating = rating  # Sent for matchmaking, the server assumes 1500 without one
+        self.time_control = time_control  # Pool to wait in ("180+2"), the server's default without one
+        self.codec = CODECS[protocol]
+        self.decoder = self.codec.decoder()
         self.connect()
+        # Working copy of the game, only touched by the receive thread
         self.board = chess.Board()
+        self.seq = 0  # Sequence number of the last applied update
+        self.resync_pending = False  # A resync was asked for, deltas are dropped until its snapshot arrives
+        self.white_time = None
+        self.black_time = None
+        self.clock_updated = time.monotonic()  # When the clock values were last received, used to count down locally
+        self.clock_delay = 0
+        self.rtt = 0
+        self.game_over = False
+        self.state = None  # Latest published ClientState
+        self.publish()
         self.color = None
         self.game_id = None
+        pygame.init()
         self.screen = pygame.display.set_mode((800, 600))
         pygame.display.set_caption("Multiplayer Chess")
-        self.clock = pygame.time.Clock()
-        self.chat_messages = []
+        self.chat_messages = collections.deque(maxlen=CHAT_HISTORY)  # Appended by both threads, which deques allow
         self.input_text = ""
         self.selected_square = None
         self.running = True
@@ -52,6 +92,25 @@ class ChessClient:
                 else:
                     print(f"Warning: Image {filename} not found at {filepath}")
 
+        # Retained rendering: fonts and text surfaces are made once, the background, squares and
+        # labels are pre-rendered, and each frame only redraws what changed since the last one
+        self.fonts = {"small": pygame.font.Font(None, 20), "clock": pygame.font.Font(None, 28),
+                      "banner": pygame.font.Font(None, 24)}
+        self.texts = {}  # (font, text, color): rendered surface
+        self.static = self.render_static()
+        self.labels = {}  # square: [(surface, position)], drawn over the piece like before
+        for col in range(8):
+            self.labels.setdefault(chess.square(col, 0), []).append(
+                (self.text("small", chr(97 + col), (0, 0, 0)), (col * SQUARE_SIZE + 20, 7 * SQUARE_SIZE + 5)))
+        for row in range(8):
+            self.labels.setdefault(chess.square(0, 7 - row), []).append(
+                (self.text("small", str(8 - row), (0, 0, 0)), (5, row * SQUARE_SIZE + 20)))
+        self.drawn_squares = {}  # square: (piece symbol or None, selected) currently on screen
+        self.drawn_position = None  # (pieces, selected square) of the last board drawn
+        self.drawn_chat = None
+        self.drawn_clocks = None
+        self.full_redraw = True
+
     def connect(self):
         try:
             self.client.connect((self.host, self.port))
@@ -59,12 +118,34 @@ class ChessClient:
             print(f"Connection failed: {e}")
             self.running = False
 
+    def send_message(self, message):
+        self.client.sendall(self.codec.encode(message))
+
+    def send_hello(self, **fields):
+        # The first message on a connection is always a JSON line, it also picks the wire format
+        hello = {"type": self.mode, "protocol": self.codec.name}
+        hello.update(fields)
+        self.client.sendall(json.dumps(hello).encode() + b"\n")
+
+    def receive_message(self):
+        messages = []
+        while not messages:
+            data = self.client.recv(4096)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            messages = self.decoder.feed(data)
+        for message in messages[1:]:
+            self.handle_message(message)
+        return messages[0]
+
     def send_initial_message(self):
         try:
-            self.client.send(json.dumps({"type": self.mode}).encode() + b"\n")
+            if self.mode == "player":
+                self.send_hello(rating=self.rating, time_control=self.time_control)
+            else:
+                self.send_hello()
             if self.mode == "spectator":
-                data = self.client.recv(1024).decode()
-                message = json.loads(data)
+                message = self.receive_message()
                 if message.get("action") == "game_list":
                     print("Available games:", message["games"])
                     game_id = input("Enter game ID to spectate (or press Enter to join first available): ")
@@ -72,76 +153,153 @@ class ChessClient:
                         game_id = message["games"][0] if message["games"] else None
                     if game_id:
                         self.game_id = int(game_id)
-                        self.client.send(json.dumps({"game_id": int(game_id)}).encode() + b"\n")
+                        self.send_message({"game_id": int(game_id)})
         except Exception as e:
             print(f"Error sending initial message: {e}")
             self.running = False
 
-    def draw_board(self):
-        square_size = 50
-        self.screen.blit(self.background, (0, 0))  # Draw background first
+    def text(self, font, text, color):
+        surface = self.texts.get((font, text, color))
+        if surface is None:
+            if len(self.texts) >= MAX_CACHED_TEXTS:
+                self.texts.clear()  # Mostly stale clock readings
+            surface = self.texts[(font, text, color)] = self.fonts[font].render(text, True, color)
+        return surface
+
+    def render_static(self):
+        # Background and empty board, everything that never changes
+        surface = self.background.copy()
         for row in range(8):
             for col in range(8):
                 color = (181, 136, 99) if (row + col) % 2 == 0 else (240, 217, 181)  # Wood-like colors
-                pygame.draw.rect(self.screen, color, (col * square_size, row * square_size, square_size, square_size))
-                piece = self.board.piece_at(chess.square(col, 7 - row))
-                if piece:
-                    piece_symbol = piece.symbol().lower()
-                    color_symbol = 'w' if piece.color == chess.WHITE else 'b'
-                    key = f"{color_symbol}{piece_symbol}"
-                    if key in self.piece_images:
-                        self.screen.blit(self.piece_images[key], (col * square_size, row * square_size))
-                # Add labels for files (a-h) and ranks (1-8)
-                font = pygame.font.Font(None, 20)
-                if row == 7:
-                    text = font.render(chr(97 + col), True, (0, 0, 0))
-                    self.screen.blit(text, (col * square_size + 20, 7 * square_size + 5))
-                if col == 0:
-                    text = font.render(str(8 - row), True, (0, 0, 0))
-                    self.screen.blit(text, (5, row * square_size + 20))
-        if self.selected_square is not None and self.mode == "player":
-            col, row = chess.square_file(self.selected_square), 7 - chess.square_rank(self.selected_square)
-            pygame.draw.rect(self.screen, (0, 255, 0, 100), (col * square_size, row * square_size, square_size, square_size), 3)
+                pygame.draw.rect(surface, color, (col * SQUARE_SIZE, row * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE))
+        return surface
+
+    def draw_square(self, square, symbol, selected):
+        col, row = chess.square_file(square), 7 - chess.square_rank(square)
+        rect = pygame.Rect(col * SQUARE_SIZE, row * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE)
+        self.screen.blit(self.static, rect, rect)
+        if symbol:
+            key = f"{'w' if symbol.isupper() else 'b'}{symbol.lower()}"
+            if key in self.piece_images:
+                self.screen.blit(self.piece_images[key], rect)
+        for text, position in self.labels.get(square, ()):
+            self.screen.blit(text, position)
+        if selected:
+            pygame.draw.rect(self.screen, (0, 255, 0, 100), rect, 3)
+        return rect
+
+    def draw_board(self, state):
+        # Only squares whose piece or selection changed since they were last drawn
+        selected = self.selected_square if self.mode == "player" else None
+        if (state.pieces, selected) == self.drawn_position:
+            return []
+        self.drawn_position = (state.pieces, selected)
+        rects = []
+        for square in chess.SQUARES:
+            key = (state.pieces.get(square), square == selected)
+            if self.drawn_squares.get(square) != key:
+                self.drawn_squares[square] = key
+                rects.append(self.draw_square(square, *key))
+        return rects
 
     def draw_chat(self):
-        font = pygame.font.Font(None, 20)  # Reduced font size from 24 to 20
-        # Moved chat box up to y=100
-        chat_box = pygame.Rect(420, 100, 350, 200)  # Reduced height from 250 to 200
-        pygame.draw.rect(self.screen, (255, 255, 255, 200), chat_box)
+        shown = (tuple(self.chat_messages)[-6:], self.input_text)  # Last 6 messages and the input line
+        if shown == self.drawn_chat:
+            return []
+        self.drawn_chat = shown
+        banner = self.text("banner", "Spectator Mode", (255, 255, 255))
+        banner_rect = banner.get_rect(topleft=(420, 90))
+        if self.mode == "spectator":
+            self.screen.blit(self.static, banner_rect, banner_rect)
+        pygame.draw.rect(self.screen, (255, 255, 255, 200), CHAT_BOX)
         y = 110
-        for msg in self.chat_messages[-6:]:  # Adjusted to show last 6 messages
-            text = font.render(msg, True, (0, 0, 0))
-            self.screen.blit(text, (430, y))
-            y += 20  # Reduced line spacing
-        input_box = pygame.Rect(420, 300, 350, 30)  # Adjusted position to y=300
-        pygame.draw.rect(self.screen, (255, 255, 255), input_box)
-        input_text = font.render(f"> {self.input_text}", True, (0, 0, 0))
-        self.screen.blit(input_text, (430, 305))
-
-    def draw_timers(self):
-        font = pygame.font.Font(None, 28)  # Reduced font size from 36 to 28
-        white_time = self.board.white_time if hasattr(self.board, 'white_time') else 600
-        black_time = self.board.black_time if hasattr(self.board, 'black_time') else 600
-        # Adjusted positions below chat box
-        white_text = font.render(f"White: {int(white_time)}s", True, (255, 255, 255))
-        black_text = font.render(f"Black: {int(black_time)}s", True, (255, 255, 255))
-        self.screen.blit(white_text, (420, 340))  # Adjusted to y=340
-        self.screen.blit(black_text, (420, 370))  # Adjusted to y=370
+        for msg in shown[0]:
+            self.screen.blit(self.text("small", msg, (0, 0, 0)), (430, y))
+            y += 20
+        pygame.draw.rect(self.screen, (255, 255, 255), INPUT_BOX)
+        self.screen.blit(self.text("small", f"> {self.input_text}", (0, 0, 0)), (430, 305))
+        rects = [CHAT_BOX.union(INPUT_BOX)]
+        if self.mode == "spectator":
+            # The banner overlaps the top of the chat box
+            rects.append(self.screen.blit(banner, banner_rect))
+        return rects
+
+    def clock_values(self, state):
+        if state.white_time is None:
+            return 600, 600
+        white_time, black_time = state.white_time, state.black_time
+        # The server only sends clocks with moves, count the side to move down locally in between.
+        # The values left the server half a round trip before they arrived.
+        if not state.game_over:
+            elapsed = max(0, time.monotonic() - state.received + state.rtt / 2000 - state.delay)
+            if state.board.turn == chess.WHITE:
+                white_time = max(0, white_time - elapsed)
+            else:
+                black_time = max(0, black_time - elapsed)
+        return white_time, black_time
+
+    def draw_timers(self, state):
+        white_time, black_time = self.clock_values(state)
+        shown = (self.format_clock(white_time), self.format_clock(black_time))
+        if shown == self.drawn_clocks:
+            return []
+        self.drawn_clocks = shown
+        self.screen.blit(self.static, TIMER_AREA, TIMER_AREA)
+        self.screen.blit(self.text("clock", f"White: {shown[0]}", (255, 255, 255)), (420, 340))
+        self.screen.blit(self.text("clock", f"Black: {shown[1]}", (255, 255, 255)), (420, 370))
+        return [TIMER_AREA]
+
+    def render(self):
+        # Draws whatever changed and pushes only those rectangles to the display
+        state = self.state
+        if self.full_redraw:
+            self.full_redraw = False
+            self.screen.blit(self.static, (0, 0))
+            self.drawn_squares.clear()
+            self.drawn_position = self.drawn_chat = self.drawn_clocks = None
+            self.draw_board(state)
+            self.draw_chat()
+            self.draw_timers(state)
+            pygame.display.flip()
+            return
+        rects = self.draw_board(state) + self.draw_chat() + self.draw_timers(state)
+        if rects:
+            pygame.display.update(rects)
+
+    def idle_timeout(self):
+        # Milliseconds until the running clock's display next changes, None while it is stopped
+        state = self.state
+        if state.white_time is None or state.game_over:
+            return None
+        white_time, black_time = self.clock_values(state)
+        remaining = white_time if state.board.turn == chess.WHITE else black_time
+        if remaining <= 0:
+            return None
+        if remaining < 10:
+            return 100
+        return int(remaining % 1 * 1000) + 1
+
+    def format_clock(self, seconds):
+        # Tenths only matter in a time scramble
+        return f"{seconds:.1f}s" if seconds < 10 else f"{int(seconds)}s"
 
     def handle_click(self, pos):
         if self.mode == "player":
-            square_size = 50
-            col, row = pos[0] // square_size, pos[1] // square_size
+            state = self.state
+            col, row = pos[0] // SQUARE_SIZE, pos[1] // SQUARE_SIZE
             square = chess.square(col, 7 - row)
             if self.selected_square is None:
-                if self.board.piece_at(square) and self.board.piece_at(square).color == self.color:
+                if state.board.piece_at(square) and state.board.piece_at(square).color == self.color:
                     self.selected_square = square
             else:
                 move = chess.Move(self.selected_square, square)
-                if move in self.board.legal_moves and self.game_id is not None:
+                if move in state.board.legal_moves and self.game_id is not None:
                     uci_move = move.uci()
                     try:
-                        self.client.send(json.dumps({"action": "move", "move": uci_move, "game_id": self.game_id}).encode() + b"\n")
+                        # The server refunds network transit from the think time we report
+                        think_ms = None if state.white_time is None else int((time.monotonic() - state.received) * 1000)
+                        self.send_message({"action": "move", "move": uci_move, "game_id": self.game_id, "think_ms": think_ms})
                         print(f"Sent move: {uci_move}")
                     except:
                         self.chat_messages.append("Error: Failed to send move. Reconnecting...")
@@ -152,97 +310,144 @@ class ChessClient:
         self.disconnected = True
         self.client.close()
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.decoder = self.codec.decoder()
         self.connect()
         if self.running and self.game_id:
-            self.client.send(json.dumps({"action": "reconnect", "game_id": self.game_id}).encode() + b"\n")
+            if self.mode == "spectator":
+                self.send_hello()
+                self.send_message({"game_id": self.game_id})
+            else:
+                color = None if self.color is None else ("white" if self.color == chess.WHITE else "black")
+                self.send_hello(action="reconnect", game_id=self.game_id, color=color)
+            self.disconnected = False
+
+    def apply_delta(self, delta):
+        if self.resync_pending:
+            return  # The snapshot on its way supersedes it
+        if delta["seq"] != self.seq + 1:
+            # Missed an update, ask the server for a full snapshot
+            print(f"Update gap (have {self.seq}, got {delta['seq']}), requesting resync")
+            self.send_message({"action": "resync", "game_id": self.game_id})
+            self.resync_pending = True
+            return
+        if delta["move"]:
+            self.board.push_uci(delta["move"])
+        self.seq = delta["seq"]
+        self.white_time = delta["white_time"]
+        self.black_time = delta["black_time"]
+        self.clock_updated = time.monotonic()
+        print(f"Current turn: {delta['turn'].capitalize()}")
+        if delta.get("is_game_over"):
+            self.game_over = True
+            if delta.get("flagged"):
+                self.chat_messages.append(f"Game Over: {delta['flagged'].capitalize()} ran out of time")
+            else:
+                self.chat_messages.append("Game Over: Checkmate" if delta.get("is_checkmate") else "Game Over")
+
+    def handle_message(self, message):
+        print(f"Received ({self.mode}): {message}")
+        action = message.get("action")
+        if action == "start":
+            self.color = chess.WHITE if message["color"] == "white" else chess.BLACK
+            self.game_id = message["game_id"]
+        elif action == "update":
+            self.board = chess.Board(message["state"]["fen"])
+            self.seq = message["state"].get("seq", 0)
+            self.resync_pending = False
+            self.white_time = message["state"]["white_time"]
+            self.black_time = message["state"]["black_time"]
+            self.clock_updated = time.monotonic()
+            self.clock_delay = message["state"].get("delay", 0)
+            self.game_over = message["state"]["is_game_over"]
+            turn = message["state"]["turn"]
+            print(f"Current turn: {turn.capitalize()}")
+        elif action == "delta":
+            self.apply_delta(message["delta"])
+        elif action == "chat":
+            self.chat_messages.append(message["message"])
+        elif action == "error":
+            self.chat_messages.append(f"Error: {message['message']}")
+        elif action == "opponent_disconnected":
+            self.chat_messages.append("Opponent disconnected. Waiting for reconnection...")
+            self.disconnected = True
+        elif action == "reconnected":
+            self.chat_messages.append("Reconnected to game!")
             self.disconnected = False
+        elif action == "ping":
+            self.rtt = message.get("rtt") or 0
+            self.send_message({"action": "pong", "t": message["t"]})
+        elif action == "game_over":
+            self.chat_messages.append(f"Game Over: {message['reason']}")
+            self.running = False
 
     def receive_messages(self):
-        buffer = ""
         while self.running:
             try:
-                data = self.client.recv(1024).decode()
-                if not data:
-                    self.disconnected = True
-                    break
-                buffer += data
-                while "\n" in buffer:
-                    message_end = buffer.index("\n")
-                    message_str = buffer[:message_end].strip()
-                    buffer = buffer[message_end + 1:].strip()
-                    if message_str:
-                        try:
-                            message = json.loads(message_str)
-                            print(f"Received ({self.mode}): {message}")
-                            action = message.get("action")
-                            if action == "start":
-                                self.color = chess.WHITE if message["color"] == "white" else chess.BLACK
-                                self.game_id = message["game_id"]
-                            elif action == "update":
-                                self.board = chess.Board(message["state"]["fen"])
-                                self.board.white_time = message["state"]["white_time"]
-                                self.board.black_time = message["state"]["black_time"]
-                                turn = message["state"]["turn"]
-                                print(f"Current turn: {turn.capitalize()}")
-                            elif action == "chat":
-                                self.chat_messages.append(message["message"])
-                            elif action == "error":
-                                self.chat_messages.append(f"Error: {message['message']}")
-                            elif action == "opponent_disconnected":
-                                self.chat_messages.append("Opponent disconnected. Waiting for reconnection...")
-                                self.disconnected = True
-                            elif action == "reconnected":
-                                self.chat_messages.append("Reconnected to game!")
-                                self.disconnected = False
-                            elif action == "game_over":
-                                self.chat_messages.append(f"Game Over: {message['reason']}")
-                                self.running = False
-                        except json.JSONDecodeError as e:
-                            print(f"JSON decode error: {e}, Buffer: {message_str[:50]}...")
-                            continue
+                data = self.client.recv(4096)
+                messages = self.decoder.feed(data) if data else None
             except Exception as e:
                 print(f"Receive error: {e}")
+                messages = None
+            if messages is None:
+                # Connection lost, keep receiving on the new connection if reconnecting worked
                 self.disconnected = True
-                break
+                if not self.running:
+                    break
+                self.reconnect()
+                if self.disconnected:
+                    break
+                continue
+            for message in messages:
+                self.handle_message(message)
+            self.publish()
+            self.wake()
 
-        if self.disconnected and self.running:
-            self.reconnect()
+    def publish(self):
+        # Snapshot of the working copy for the renderer, one per batch of messages
+        pieces = {square: piece.symbol() for square, piece in self.board.piece_map().items()}
+        self.state = ClientState(self.board.copy(stack=False), pieces, self.white_time, self.black_time,
+                                 self.clock_updated, self.clock_delay, self.rtt, self.game_over)
+
+    def wake(self):
+        # One event per batch of messages, the render loop redraws whatever they changed
+        try:
+            pygame.event.post(pygame.event.Event(NETWORK_UPDATE))
+        except pygame.error:
+            pass  # Queue full, the loop is awake anyway
+
+    def handle_event(self, event):
+        if event.type == pygame.QUIT:
+            self.running = False
+        elif event.type in (pygame.WINDOWEXPOSED, pygame.VIDEOEXPOSE):
+            self.full_redraw = True
+        elif event.type == pygame.MOUSEBUTTONDOWN and self.color is not None and not self.disconnected:
+            self.handle_click(event.pos)
+        elif event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_RETURN:
+                if self.input_text:
+                    try:
+                        self.send_message({"action": "chat", "message": self.input_text})
+                        self.chat_messages.append(f"You: {self.input_text}")
+                        self.input_text = ""
+                    except:
+                        self.chat_messages.append("Error: Failed to send chat. Reconnecting...")
+                        self.reconnect()
+            elif event.key == pygame.K_BACKSPACE:
+                self.input_text = self.input_text[:-1]
+            else:
+                self.input_text += event.unicode
 
     def run(self):
         self.send_initial_message()
         threading.Thread(target=self.receive_messages, daemon=True).start()
-        pygame.init()
-        font = pygame.font.Font(None, 36)
+        self.render()
         while self.running:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.running = False
-                elif event.type == pygame.MOUSEBUTTONDOWN and self.color is not None and not self.disconnected:
-                    self.handle_click(event.pos)
-                elif event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_RETURN:
-                        if self.input_text:
-                            try:
-                                self.client.send(json.dumps({"action": "chat", "message": self.input_text}).encode() + b"\n")
-                                self.chat_messages.append(f"You: {self.input_text}")
-                                self.input_text = ""
-                            except:
-                                self.chat_messages.append("Error: Failed to send chat. Reconnecting...")
-                                self.reconnect()
-                    elif event.key == pygame.K_BACKSPACE:
-                        self.input_text = self.input_text[:-1]
-                    else:
-                        self.input_text += event.unicode
-
-            self.draw_board()
-            self.draw_chat()
-            self.draw_timers()
-            if self.mode == "spectator":
-                font = pygame.font.Font(None, 24)  # Reduced from 30 to 24
-                text = font.render("Spectator Mode", True, (255, 255, 255))
-                self.screen.blit(text, (420, 90))  # Adjusted to y=90
-            pygame.display.flip()
-            self.clock.tick(60)
+            # Sleeps until input, a network update or the next visible tick of the running clock
+            timeout = self.idle_timeout()
+            event = pygame.event.wait() if timeout is None else pygame.event.wait(timeout)
+            for event in [event] + pygame.event.get():
+                self.handle_event(event)
+            self.render()
 
         self.client.close()
         pygame.quit()
@@ -250,6 +455,9 @@ class ChessClient:
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Multiplayer Chess Client")
     parser.add_argument("--mode", choices=["player", "spectator"], default="player", help="Mode to join as (player or spectator)")
+    parser.add_argument("--protocol", choices=sorted(CODECS), default="json", help="Wire format (binary is more compact)")
+    parser.add_argument("--rating", type=int, help="Rating to be matched by (players only)")
+    parser.add_argument("--time-control", help="Time control pool to play in, e.g. 180+2 (the server lists its pools if unknown)")
     args = parser.parse_args()
-    client = ChessClient(mode=args.mode)
+    client = ChessClient(mode=args.mode, protocol=args.protocol, rating=args.rating, time_control=args.time_control)
     client.run()
\ No newline at end of file
@@ -0,0 +1,152 @@
+import collections
+import socket
+import threading
+import time
+from protocol import JSON
+
+IOV_MAX = 1024  # Most buffers a single sendmsg (writev) call accepts on Linux
+HIGH_WATER = {"player": 1 << 20, "spectator": 256 << 10}  # Default bytes a client's outbound queue may hold
+EVICT_AFTER = 10  # Seconds a client's queue may stay saturated before the client is dropped
+
+
+class SlowConsumerError(ConnectionError):
+    pass
+
+
+class OutboundQueue:
+    # Bounded queue of encoded frames waiting for a slow socket, shared by both server modes.
+    # A frame that would take the queue past its high-water mark is dropped together with
+    # everything still queued, and the connection is flagged so the server sends it the latest
+    # snapshot instead, which supersedes whatever it missed. A client whose queue overflows
+    # again without having drained for evict_after seconds is dropped.
+    def __init__(self, high_water=HIGH_WATER["player"], evict_after=EVICT_AFTER):
+        self.queue = collections.deque()
+        self.queued_bytes = 0
+        self.high_water = high_water
+        self.evict_after = evict_after
+        self.needs_snapshot = False
+        self.saturated_since = None  # time.monotonic() of the first overflow since the queue last drained
+        self.stats = {"frames": 0, "bytes": 0, "overflows": 0, "dropped": 0}  # Frames and bytes queued, overflows, frames dropped
+        self.evicted = False
+
+    def push(self, data):
+        # Returns the bytes queued, 0 if the queue overflowed. Expects the caller's lock.
+        if self.queued_bytes + len(data) <= self.high_water or not self.queue:
+            self.queue.append(data)
+            self.queued_bytes += len(data)
+            self.stats["frames"] += 1
+            self.stats["bytes"] += len(data)
+            return len(data)
+        now = time.monotonic()
+        self.stats["overflows"] += 1
+        self.stats["dropped"] += len(self.queue) + 1
+        self.queue.clear()
+        self.queued_bytes = 0
+        self.needs_snapshot = True
+        if self.saturated_since is None:
+            self.saturated_since = now
+        elif now - self.saturated_since >= self.evict_after:
+            self.evicted = True
+            raise SlowConsumerError(f"Outbound queue saturated for {now - self.saturated_since:.1f}s")
+        return 0
+
+    def take(self):
+        # Everything queued, for one write. Expects the caller's lock.
+        frames = list(self.queue)
+        self.queue.clear()
+        self.queued_bytes = 0
+        return frames
+
+    def drained(self):
+        # The writer caught up, the client is not saturated any more
+        self.saturated_since = None
+
+    def queue_stats(self):
+        return dict(self.stats, queued_frames=len(self.queue), queued_bytes=self.queued_bytes,
+                    high_water=self.high_water, evicted=self.evicted)
+
+
+def send_frames(sock, frames):
+    # Writes every pending frame with as few syscalls as possible. The frames are shared,
+    # immutable bytes objects (encoded once per broadcast), so they are sent without copying.
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(frames))
+        return
+    views = [memoryview(frame) for frame in frames]
+    first = 0
+    while first < len(views):
+        sent = sock.sendmsg(views[first:first + IOV_MAX])
+        while sent:
+            size = len(views[first])
+            if sent >= size:
+                sent -= size
+                first += 1
+            else:
+                views[first] = views[first][sent:]
+                sent = 0
+
+
+class ClientConnection(OutboundQueue):
+    # Socket wrapper with its own outbound queue. send() only enqueues, a writer thread
+    # does the blocking socket writes, so a slow reader never stalls whoever is broadcasting.
+    def __init__(self, sock, addr=None):
+        super().__init__()
+        self.sock = sock
+        self.addr = addr
+        self.codec = JSON  # Wire format, may be switched by the client's initial message
+        self.ready = threading.Condition()
+        self.closed = False
+        threading.Thread(target=self.writer_loop, daemon=True).start()
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def send(self, data):
+        with self.ready:
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            try:
+                sent = self.push(data)
+            except SlowConsumerError:
+                self.abort()
+                raise
+            self.ready.notify()
+        return sent
+
+    def writer_loop(self):
+        while True:
+            with self.ready:
+                while not self.queue and not self.closed:
+                    self.ready.wait()
+                if not self.queue:
+                    break
+                frames = self.take()
+            try:
+                send_frames(self.sock, frames)
+            except OSError:
+                with self.ready:
+                    self.closed = True
+                    self.queue.clear()
+                break
+            with self.ready:
+                if not self.queue:
+                    self.drained()
+        self.sock.close()
+
+    def abort(self):
+        # Drops whatever is queued and wakes both the writer and the reader of this socket.
+        # Expects self.ready to be held.
+        self.closed = True
+        self.queue.clear()
+        self.queued_bytes = 0
+        self.ready.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        # Pending messages are still flushed by the writer thread, which then closes the socket
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
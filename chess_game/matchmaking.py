@@ -0,0 +1,156 @@
+import bisect
+import collections
+import itertools
+import time
+
+# Matchmaking queue. Waiting players are kept in one pool per time control, within a pool in
+# buckets of similar rating, and within a bucket by rating point, each point an OrderedDict in
+# arrival order. Joining or leaving the queue is a few dict operations whatever its size, plus
+# a bisect into the bucket's list of occupied points, which never holds more than BUCKET_WIDTH
+# of them (however many unrated players share the 1500 point). Pairing runs in batches on a tick
+# (ChessServer.matchmaking_thread): the longest-waiting players go first and take the nearest
+# opponent inside their rating window, which widens the longer they wait, so a lone player is
+# eventually matched with anybody in the pool. A player nobody fitted is only searched for
+# again once its window reaches a rating it has not covered yet or someone joins its pool.
+
+DEFAULT_RATING = 1500  # For players who do not send one
+MAX_RATING = 4000
+BUCKET_WIDTH = 50  # Rating points per bucket
+INITIAL_WINDOW = 50  # Rating difference accepted straight away
+WINDOW_GROWTH = 25  # Rating points added to the window per second of waiting
+PAIRING_INTERVAL = 0.1  # Seconds between pairing ticks
+
+
+def time_control_name(time_control):
+    # "600+5": initial seconds + increment seconds, the name clients ask for a pool by
+    return f"{time_control['initial_time']:g}+{time_control['increment']:g}"
+
+
+def parse_time_control(name, delay=0):
+    initial_time, _, increment = name.partition("+")
+    return {"initial_time": float(initial_time), "increment": float(increment or 0), "delay": delay}
+
+
+class Matchmaker:
+    def __init__(self, time_controls, default):
+        self.time_controls = {time_control_name(time_control): time_control for time_control in time_controls}
+        self.default = time_control_name(default)  # Pool of players who do not ask for one
+        self.pools = {name: {} for name in self.time_controls}  # pool name: {bucket index: {rating point: OrderedDict player: entry}}
+        self.points = {name: {} for name in self.time_controls}  # pool name: {bucket index: sorted rating points in use}
+        self.entries = {}  # player: {"player", "rating", "pool", "bucket", "since", "retry"}, in arrival order
+        self.arrivals = {name: 0 for name in self.time_controls}  # Players that ever joined each pool
+
+    def __len__(self):
+        return len(self.entries)
+
+    def pool_for(self, hello):
+        # The pool a player's initial message asks for, None when there is no such pool
+        name = hello.get("time_control") or self.default
+        return name if name in self.pools else None
+
+    def enqueue(self, player, rating=None, pool=None, now=None):
+        if not isinstance(rating, (int, float)) or not 0 <= rating <= MAX_RATING:
+            rating = DEFAULT_RATING
+        pool = pool or self.default
+        bucket = int(rating // BUCKET_WIDTH)
+        entry = {"player": player, "rating": rating, "pool": pool, "bucket": bucket,
+                 "since": time.monotonic() if now is None else now,
+                 "retry": None}  # (window, pool arrivals) that must change before the next search
+        self.entries[player] = entry
+        self.arrivals[pool] += 1
+        points = self.pools[pool].setdefault(bucket, {})
+        point = int(rating)
+        if point not in points:
+            points[point] = collections.OrderedDict()
+            bisect.insort(self.points[pool].setdefault(bucket, []), point)
+        points[point][player] = entry
+        return entry
+
+    def cancel(self, player):
+        # True if the player was waiting
+        entry = self.entries.pop(player, None)
+        if entry is None:
+            return False
+        buckets = self.pools[entry["pool"]]
+        bucket = buckets[entry["bucket"]]
+        point = int(entry["rating"])
+        players = bucket[point]
+        del players[player]
+        if not players:
+            del bucket[point]
+            points = self.points[entry["pool"]][entry["bucket"]]
+            del points[bisect.bisect_left(points, point)]
+            if not bucket:
+                del buckets[entry["bucket"]], self.points[entry["pool"]][entry["bucket"]]
+        return True
+
+    def window(self, waited):
+        return INITIAL_WINDOW + WINDOW_GROWTH * waited
+
+    def pair(self, now=None):
+        # One tick: returns [(entry, entry)], the longer-waiting player first, and takes both
+        # out of the queue. Players nobody fits yet stay for the next tick.
+        now = time.monotonic() if now is None else now
+        pairs = []
+        reach = {name: (min(buckets), max(buckets)) for name, buckets in self.pools.items() if buckets}
+        for entry in list(self.entries.values()):
+            if self.entries.get(entry["player"]) is not entry:
+                continue  # Paired earlier in this tick
+            window = self.window(now - entry["since"])
+            arrivals = self.arrivals[entry["pool"]]
+            retry = entry["retry"]
+            if retry is not None and window < retry[0] and arrivals == retry[1]:
+                continue  # Nothing it could be paired with has come within reach
+            opponent, next_window = self.find_opponent(entry, window, reach[entry["pool"]])
+            if opponent is not None:
+                self.cancel(entry["player"])
+                self.cancel(opponent["player"])
+                pairs.append((entry, opponent))
+            else:
+                entry["retry"] = (next_window, arrivals)
+        return pairs
+
+    def find_opponent(self, entry, window, reach):
+        # Searches the player's own bucket, then the ones either side of it, until the window
+        # or the pool's lowest and highest buckets are passed. Each bucket offers its closest
+        # rated player (the longest-waiting on a tie), the closer of the two sides wins.
+        # Returns (opponent or None, the smallest window that could find someone else).
+        buckets = self.pools[entry["pool"]]
+        points = self.points[entry["pool"]]
+        low, high = reach
+        center = entry["bucket"]
+        distance = 0
+        next_window = float("inf")
+        while center - distance >= low or center + distance <= high:
+            if distance * BUCKET_WIDTH > window + BUCKET_WIDTH:
+                # Everyone further out is at least this far away
+                return None, min(next_window, (distance - 1) * BUCKET_WIDTH)
+            best = None
+            for index in {center - distance, center + distance}:
+                candidate = self.closest(buckets.get(index), points.get(index), entry) if index in buckets else None
+                if candidate is not None:
+                    difference = abs(candidate["rating"] - entry["rating"])
+                    if difference > window:
+                        next_window = min(next_window, difference)
+                    elif best is None or difference < abs(best["rating"] - entry["rating"]):
+                        best = candidate
+            if best is not None:
+                return best, None
+            distance += 1
+        return None, next_window
+
+    @staticmethod
+    def closest(bucket, points, entry):
+        # The player rated nearest to entry in one bucket, to the rating point: the points
+        # either side of entry's own are the only ones that can hold it. The longest-waiting
+        # player of a point stands for it, the longest-waiting of two equally close points wins.
+        index = bisect.bisect_left(points, int(entry["rating"]))
+        best = None
+        for point in points[max(0, index - 1):index + 2]:
+            for candidate in itertools.islice(bucket[point].values(), 2):
+                if candidate is not entry:
+                    difference = abs(candidate["rating"] - entry["rating"])
+                    if best is None or (difference, candidate["since"]) < (abs(best["rating"] - entry["rating"]), best["since"]):
+                        best = candidate
+                    break
+        return best
@@ -0,0 +1,208 @@
+import bisect
+import collections
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# In-process metrics for the game server, rendered in the Prometheus text format, and a
+# sampling profiler that can be switched on while the server runs. Both are served by a small
+# HTTP server on a local port (server.py --metrics-port):
+#
+#   curl localhost:9100/metrics
+#   curl 'localhost:9100/profile?seconds=10&match=handle_player'   # hottest stacks, collapsed
+#   curl localhost:9100/profile/start ... curl localhost:9100/profile/stop
+#   curl localhost:9100/connections   # JSON, outbound queue depth and drops of every connection
+#
+# The collapsed output ("thread;outer;...;inner count" per line) feeds flamegraph.pl directly.
+
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)  # Seconds
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, source=None):
+        self.name = name
+        self.help = help
+        self.source = source  # Callable returning the value, for totals kept elsewhere
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, self.source() if self.source else self.value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Per bucket, the last one is +Inf
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{bound}"}}', cumulative
+        yield f"{self.name}_sum", total
+        yield f"{self.name}_count", cumulative
+
+
+class Metrics:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, source=None):
+        return self.add(Counter(name, help, source))
+
+    def gauge(self, name, help, source):
+        return self.add(Gauge(name, help, source))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name} {value}" for name, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    # Samples the stack of every other thread with sys._current_frames() every interval
+    # seconds and counts identical stacks. Costs nothing while stopped.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.started = None
+        self.running = False
+
+    def start(self, interval=0.005):
+        with self.lock:
+            if self.thread is not None:
+                return False
+            self.stacks = collections.Counter()
+            self.samples = 0
+            self.started = time.monotonic()
+            self.running = True
+            self.thread = threading.Thread(target=self.sample_loop, args=(interval,), name="profiler", daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        with self.lock:
+            thread = self.thread
+            self.running = False
+        if thread is not None:
+            thread.join()
+        with self.lock:
+            self.thread = None
+
+    def sample_loop(self, interval):
+        own = threading.get_ident()
+        while self.running:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(interval)
+
+    def report(self, match=None, limit=50):
+        # Collapsed stacks, most frequent first, optionally only those passing through match
+        stacks = [(count, stack) for stack, count in self.stacks.items() if match is None or match in stack]
+        stacks.sort(reverse=True)
+        elapsed = time.monotonic() - self.started if self.started else 0
+        lines = [f"# {self.samples} samples over {elapsed:.1f}s"]
+        lines.extend(f"{stack} {count}" for count, stack in stacks[:limit])
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        metrics, profiler = self.server.metrics, self.server.profiler
+        if url.path == "/metrics":
+            self.reply(200, metrics.render(), "text/plain; version=0.0.4")
+        elif url.path == "/connections" and self.server.connections is not None:
+            self.reply(200, json.dumps(self.server.connections()) + "\n", "application/json")
+        elif url.path == "/profile":
+            # Samples for a while and answers with the result, other requests are still served
+            if not profiler.start(float(query.get("interval", 0.005))):
+                self.reply(409, "Profiler already running\n")
+                return
+            time.sleep(min(float(query.get("seconds", 5)), 300))
+            profiler.stop()
+            self.reply(200, profiler.report(query.get("match"), int(query.get("limit", 50))))
+        elif url.path == "/profile/start":
+            started = profiler.start(float(query.get("interval", 0.005)))
+            self.reply(200 if started else 409, "Profiler started\n" if started else "Profiler already running\n")
+        elif url.path == "/profile/stop":
+            profiler.stop()
+            self.reply(200, profiler.report(query.get("match"), int(query.get("limit", 50))))
+        else:
+            self.reply(404, "Not found\n")
+
+    def reply(self, status, body, content_type="text/plain"):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would drown the server's own log
+
+
+def serve_metrics(metrics, profiler, host="127.0.0.1", port=9100, connections=None):
+    # Runs in a daemon thread, so it answers even while the event loop or a lock is busy
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    server.profiler = profiler
+    server.connections = connections  # Callable returning one dict per connection, or None
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,383 @@
+import json
+import logging
+import struct
+from chess_logic import pack_uci, packed_uci
+
+# Wire formats shared by the server and the client. JSON lines is the default. A client
+# opts into the binary framing by sending {"protocol": "binary"} in its first message
+# (which is always a JSON line); every message after that, in both directions, is binary.
+# Both codecs decode to the same message dicts, so the game logic does not care which
+# one a connection uses.
+
+log = logging.getLogger("chess_protocol")
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class JsonCodec:
+    name = "json"
+
+    def encode(self, message):
+        return (json.dumps(message) + "\n").encode()
+
+    def decoder(self, data=b""):
+        return JsonDecoder(data)
+
+
+class JsonDecoder:
+    # Only complete lines are decoded, so a multi-byte UTF-8 character split across two
+    # recv() calls is never decoded in halves. The buffer is trimmed once per feed() and
+    # only the new bytes are searched for a newline, which keeps large bursts linear.
+    def __init__(self, data=b""):
+        self.buffer = bytearray(data)
+        self.scanned = 0
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        start = 0
+        while True:
+            end = self.buffer.find(b"\n", max(start, self.scanned))
+            if end == -1:
+                break
+            line = self.buffer[start:end].strip()
+            start = end + 1
+            if line:
+                try:
+                    messages.append(json.loads(line))
+                except ValueError as e:
+                    log.warning("JSON decode error: %s, Buffer: %s...", e, bytes(line[:50]))
+        del self.buffer[:start]
+        self.scanned = len(self.buffer)
+        return messages
+
+
+# Binary frames: u16 payload length, u8 message type, payload. Integers are big endian,
+# clocks are integer milliseconds and moves are packed into 16 bits.
+HEADER = struct.Struct("!HB")
+MAX_PAYLOAD = 0xFFFF
+
+START = 1
+UPDATE = 2
+DELTA = 3
+CHAT = 4
+ERROR = 5
+OPPONENT_DISCONNECTED = 6
+RECONNECTED = 7
+GAME_LIST = 8
+MOVE = 9
+RECONNECT = 10
+RESYNC = 11
+JOIN = 12
+PING = 13
+PONG = 14
+STATS = 15  # Empty payload asks for the server's metrics, the reply carries them as UTF-8 text
+GAME_LIST_PART = 16  # Leading chunk of a game list too long for one frame, the GAME_LIST frame ends it
+GAME_LIST_CHUNK = MAX_PAYLOAD // 4  # Game ids per frame
+
+START_STRUCT = struct.Struct("!BI")  # color (0 white, 1 black), game_id
+GAME_ID_STRUCT = struct.Struct("!I")
+RECONNECTED_STRUCT = struct.Struct("!IB")  # game_id, color
+RECONNECT_STRUCT = struct.Struct("!IB")  # game_id, requested color (0 white, 1 black, NO_COLOR any free seat)
+MOVE_STRUCT = struct.Struct("!IHI")  # game_id, move, think ms
+PING_STRUCT = struct.Struct("!QI")  # server ms, last round trip ms
+PONG_STRUCT = struct.Struct("!Q")  # server ms from the ping
+DELTA_STRUCT = struct.Struct("!IHIIB")  # seq, move, white ms, black ms, flags
+UPDATE_STRUCT = struct.Struct("!IIIIIB")  # seq, white ms, black ms, increment ms, delay ms, flags
+BOARD_STRUCT = struct.Struct("!32sBBBHH")  # squares (4 bits each), castling, en passant, turn, halfmove, fullmove
+HISTORY_COUNT = struct.Struct("!H")
+
+# Status flags shared by deltas and snapshots
+BLACK_TO_MOVE = 1
+CHECKMATE = 2
+STALEMATE = 4
+GAME_OVER = 8
+WHITE_FLAGGED = 16
+BLACK_FLAGGED = 32
+
+NO_MOVE = 0xFFFF
+NO_TIME = 0xFFFFFFFF
+NO_GAME = 0
+NO_SQUARE = 0xFF
+NO_COLOR = 0xFF
+COLOR_CODES = {"white": 0, "black": 1}
+PIECE_CODES = {symbol: code for code, symbol in enumerate(" PNBRQK", 0) if symbol != " "}
+PIECE_CODES.update({symbol.lower(): code + 8 for symbol, code in list(PIECE_CODES.items())})
+PIECE_SYMBOLS = {code: symbol for symbol, code in PIECE_CODES.items()}
+CASTLING = (("K", 1), ("Q", 2), ("k", 4), ("q", 8))
+
+
+def pack_square(name):
+    return (ord(name[0]) - 97) + 8 * (ord(name[1]) - 49)
+
+
+def square_name(square):
+    return chr(97 + (square & 7)) + chr(49 + (square >> 3))
+
+
+def encode_move(uci):
+    # Moves use ChessGame's 16-bit packing, NO_MOVE stands for none
+    return NO_MOVE if uci is None else pack_uci(uci)
+
+
+def decode_move(value):
+    if value == NO_MOVE:
+        return None
+    if value >> 12 not in (0, 2, 3, 4, 5):
+        raise ProtocolError(f"Invalid promotion piece {value >> 12}")
+    return packed_uci(value)
+
+
+def pack_fen(fen):
+    placement, turn, castling, en_passant, halfmove, fullmove = fen.split()
+    squares = bytearray(32)
+    rank = 7
+    file = 0
+    for char in placement:
+        if char == "/":
+            rank -= 1
+            file = 0
+        elif char.isdigit():
+            file += int(char)
+        else:
+            square = rank * 8 + file
+            squares[square >> 1] |= PIECE_CODES[char] << (4 * (square & 1))
+            file += 1
+    rights = sum(bit for symbol, bit in CASTLING if symbol in castling)
+    ep = NO_SQUARE if en_passant == "-" else pack_square(en_passant)
+    return BOARD_STRUCT.pack(bytes(squares), rights, ep, turn == "b", int(halfmove), int(fullmove))
+
+
+def unpack_fen(view, offset):
+    squares, rights, ep, black, halfmove, fullmove = BOARD_STRUCT.unpack_from(view, offset)
+    ranks = []
+    for rank in range(7, -1, -1):
+        row = ""
+        empty = 0
+        for file in range(8):
+            square = rank * 8 + file
+            code = squares[square >> 1] >> (4 * (square & 1)) & 15
+            if code:
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                row += PIECE_SYMBOLS[code]
+            else:
+                empty += 1
+        if empty:
+            row += str(empty)
+        ranks.append(row)
+    castling = "".join(symbol for symbol, bit in CASTLING if rights & bit) or "-"
+    en_passant = "-" if ep == NO_SQUARE else square_name(ep)
+    return f"{'/'.join(ranks)} {'b' if black else 'w'} {castling} {en_passant} {halfmove} {fullmove}"
+
+
+def to_ms(seconds):
+    return max(0, round(seconds * 1000))
+
+
+def pack_status(state):
+    flags = BLACK_TO_MOVE if state["turn"] == "black" else 0
+    if state.get("is_checkmate"):
+        flags |= CHECKMATE
+    if state.get("is_stalemate"):
+        flags |= STALEMATE
+    if state.get("is_game_over"):
+        flags |= GAME_OVER
+    if state.get("flagged") == "white":
+        flags |= WHITE_FLAGGED
+    elif state.get("flagged") == "black":
+        flags |= BLACK_FLAGGED
+    return flags
+
+
+def unpack_flagged(flags):
+    if flags & WHITE_FLAGGED:
+        return "white"
+    if flags & BLACK_FLAGGED:
+        return "black"
+    return None
+
+
+class BinaryCodec:
+    name = "binary"
+
+    def encode(self, message):
+        action = message.get("action")
+        if action is None and "game_id" in message:
+            kind, payload = JOIN, GAME_ID_STRUCT.pack(message["game_id"] or NO_GAME)
+        elif action == "delta":
+            delta = message["delta"]
+            kind = DELTA
+            payload = DELTA_STRUCT.pack(delta["seq"], encode_move(delta["move"]), to_ms(delta["white_time"]), to_ms(delta["black_time"]), pack_status(delta))
+        elif action == "update":
+            state = message["state"]
+            history = state["move_history"]
+            kind = UPDATE
+            payload = b"".join([
+                UPDATE_STRUCT.pack(state["seq"], to_ms(state["white_time"]), to_ms(state["black_time"]), to_ms(state.get("increment", 0)), to_ms(state.get("delay", 0)), pack_status(state)),
+                pack_fen(state["fen"]),
+                HISTORY_COUNT.pack(len(history)),
+                struct.pack(f"!{len(history)}H", *map(encode_move, history))
+            ])
+        elif action == "move":
+            think_ms = message.get("think_ms")
+            kind, payload = MOVE, MOVE_STRUCT.pack(message.get("game_id") or NO_GAME, encode_move(message["move"]), NO_TIME if think_ms is None else think_ms)
+        elif action == "ping":
+            rtt = message.get("rtt")
+            kind, payload = PING, PING_STRUCT.pack(message["t"], NO_TIME if rtt is None else rtt)
+        elif action == "pong":
+            kind, payload = PONG, PONG_STRUCT.pack(message["t"])
+        elif action in ("chat", "error"):
+            kind = CHAT if action == "chat" else ERROR
+            payload = message["message"].encode()[:MAX_PAYLOAD]
+        elif action == "stats":
+            kind, payload = STATS, message.get("metrics", "").encode()[:MAX_PAYLOAD]
+        elif action == "start":
+            kind, payload = START, START_STRUCT.pack(message["color"] == "black", message["game_id"])
+        elif action == "opponent_disconnected":
+            kind, payload = OPPONENT_DISCONNECTED, GAME_ID_STRUCT.pack(message["game_id"])
+        elif action == "reconnected":
+            kind, payload = RECONNECTED, RECONNECTED_STRUCT.pack(message["game_id"], message["color"] == "black")
+        elif action == "game_list":
+            return self.encode_game_list(message["games"])
+        elif action == "reconnect":
+            kind, payload = RECONNECT, RECONNECT_STRUCT.pack(message.get("game_id") or NO_GAME, COLOR_CODES.get(message.get("color"), NO_COLOR))
+        elif action == "resync":
+            kind, payload = RESYNC, GAME_ID_STRUCT.pack(message.get("game_id") or NO_GAME)
+        else:
+            raise ProtocolError(f"Cannot encode {action!r} as binary")
+        if len(payload) > MAX_PAYLOAD:
+            raise ProtocolError(f"{action} frame too large ({len(payload)} bytes)")
+        return HEADER.pack(len(payload), kind) + payload
+
+    def encode_game_list(self, games):
+        # Split over as many frames as it takes, the decoder joins them into one message
+        frames = []
+        for start in range(0, max(len(games), 1), GAME_LIST_CHUNK):
+            chunk = games[start:start + GAME_LIST_CHUNK]
+            kind = GAME_LIST if start + GAME_LIST_CHUNK >= len(games) else GAME_LIST_PART
+            frames.append(HEADER.pack(4 * len(chunk), kind) + struct.pack(f"!{len(chunk)}I", *chunk))
+        return b"".join(frames)
+
+    def decoder(self, data=b""):
+        return BinaryDecoder(data)
+
+
+def unpack_exact(layout, frame):
+    # A frame's payload must be exactly its struct, fields are never read from the next frame
+    if len(frame) != layout.size:
+        raise ProtocolError(f"{len(frame)} byte payload, expected {layout.size}")
+    return layout.unpack(frame)
+
+
+def decode_frame(kind, frame):
+    # frame is the payload alone, a memoryview ending where the header's length says
+    if kind == DELTA:
+        seq, move, white_ms, black_ms, flags = unpack_exact(DELTA_STRUCT, frame)
+        delta = {"seq": seq, "move": decode_move(move), "turn": "black" if flags & BLACK_TO_MOVE else "white",
+                 "white_time": white_ms / 1000, "black_time": black_ms / 1000}
+        if flags & GAME_OVER:
+            delta["is_checkmate"] = bool(flags & CHECKMATE)
+            delta["is_stalemate"] = bool(flags & STALEMATE)
+            if flags & (WHITE_FLAGGED | BLACK_FLAGGED):
+                delta["flagged"] = unpack_flagged(flags)
+            delta["is_game_over"] = True
+        return {"action": "delta", "delta": delta}
+    if kind == MOVE:
+        game_id, move, think_ms = unpack_exact(MOVE_STRUCT, frame)
+        return {"action": "move", "move": decode_move(move), "game_id": game_id or None,
+                "think_ms": None if think_ms == NO_TIME else think_ms}
+    if kind == PING:
+        sent_at, rtt = unpack_exact(PING_STRUCT, frame)
+        return {"action": "ping", "t": sent_at, "rtt": None if rtt == NO_TIME else rtt}
+    if kind == PONG:
+        sent_at, = unpack_exact(PONG_STRUCT, frame)
+        return {"action": "pong", "t": sent_at}
+    if kind == STATS:
+        return {"action": "stats", "metrics": str(frame, "utf-8", "replace")}
+    if kind in (CHAT, ERROR):
+        return {"action": "chat" if kind == CHAT else "error", "message": str(frame, "utf-8", "replace")}
+    if kind == UPDATE:
+        fixed = UPDATE_STRUCT.size + BOARD_STRUCT.size
+        count, = HISTORY_COUNT.unpack_from(frame, fixed) if len(frame) >= fixed + HISTORY_COUNT.size else (0,)
+        if len(frame) != fixed + HISTORY_COUNT.size + 2 * count:
+            raise ProtocolError(f"{len(frame)} byte update, expected {fixed + HISTORY_COUNT.size + 2 * count}")
+        seq, white_ms, black_ms, increment_ms, delay_ms, flags = UPDATE_STRUCT.unpack_from(frame, 0)
+        fen = unpack_fen(frame, UPDATE_STRUCT.size)
+        history = [decode_move(move) for move in struct.unpack_from(f"!{count}H", frame, fixed + HISTORY_COUNT.size)]
+        return {"action": "update", "state": {
+            "seq": seq, "fen": fen, "turn": "black" if flags & BLACK_TO_MOVE else "white",
+            "white_time": white_ms / 1000, "black_time": black_ms / 1000,
+            "increment": increment_ms / 1000, "delay": delay_ms / 1000, "move_history": history,
+            "is_checkmate": bool(flags & CHECKMATE), "is_stalemate": bool(flags & STALEMATE),
+            "flagged": unpack_flagged(flags), "is_game_over": bool(flags & GAME_OVER)}}
+    if kind == START:
+        black, game_id = unpack_exact(START_STRUCT, frame)
+        return {"action": "start", "color": "black" if black else "white", "game_id": game_id}
+    if kind == RECONNECT:
+        game_id, color = unpack_exact(RECONNECT_STRUCT, frame)
+        return {"action": "reconnect", "game_id": game_id or None, "color": {0: "white", 1: "black"}.get(color)}
+    if kind in (OPPONENT_DISCONNECTED, RESYNC, JOIN):
+        game_id, = unpack_exact(GAME_ID_STRUCT, frame)
+        if kind == JOIN:
+            return {"game_id": game_id or None}
+        action = {OPPONENT_DISCONNECTED: "opponent_disconnected", RESYNC: "resync"}[kind]
+        return {"action": action, "game_id": game_id or None}
+    if kind == RECONNECTED:
+        game_id, black = unpack_exact(RECONNECTED_STRUCT, frame)
+        return {"action": "reconnected", "game_id": game_id, "color": "black" if black else "white"}
+    if kind in (GAME_LIST, GAME_LIST_PART):
+        if len(frame) % 4:
+            raise ProtocolError(f"{len(frame)} byte game list, expected a multiple of 4")
+        return {"action": "game_list", "games": list(struct.unpack(f"!{len(frame) // 4}I", frame))}
+    raise ProtocolError(f"Unknown frame type {kind}")
+
+
+class BinaryDecoder:
+    # Frames are parsed in place on memoryview slices of the receive buffer, each bounded by
+    # its header's length, and the buffer is trimmed once per feed()
+    def __init__(self, data=b""):
+        self.buffer = bytearray(data)
+        self.game_list = []  # Game ids from GAME_LIST_PART frames, until the GAME_LIST frame that ends them
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        offset = 0
+        view = memoryview(self.buffer)
+        try:
+            while len(view) - offset >= HEADER.size:
+                length, kind = HEADER.unpack_from(view, offset)
+                end = offset + HEADER.size + length
+                if end > len(view):
+                    break
+                frame = view[offset + HEADER.size:end]
+                try:
+                    message = decode_frame(kind, frame)
+                except (struct.error, ProtocolError) as e:
+                    # Its length is known, so only this frame is lost, like a bad JSON line
+                    log.warning("Malformed frame type %d dropped: %s", kind, e)
+                    offset = end
+                    continue
+                finally:
+                    frame.release()  # Even if the logged error's traceback still refers to it
+                if kind == GAME_LIST_PART:
+                    self.game_list += message["games"]
+                else:
+                    if kind == GAME_LIST and self.game_list:
+                        message["games"] = self.game_list + message["games"]
+                        self.game_list = []
+                    messages.append(message)
+                offset = end
+        finally:
+            view.release()
+        del self.buffer[:offset]
+        return messages
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+CODECS = {codec.name: codec for codec in (JSON, BINARY)}
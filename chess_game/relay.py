@@ -0,0 +1,224 @@
+import asyncio
+import json
+import threading
+import time
+import chess
+from async_server import AsyncChessServer, StreamClient
+from connection import EVICT_AFTER
+from protocol import CODECS
+from server import log
+
+# Spectator relay: a server that owns no games, it follows them on an upstream server and fans
+# their updates out to its own spectators. However many spectators watch a game through a relay,
+# the upstream server sends each update to the relay once, so a popular game costs the process
+# that validates its moves one connection per relay. The relay speaks the ordinary spectator
+# protocol on both sides, so relays can be chained into a tree:
+#
+#   game server  <-  relay  <-  relay  <-  spectators
+#
+# Late joiners get a catch-up snapshot from the relay's mirror of the game, and spectator chat
+# is shown to the relay's own audience and forwarded upstream to everybody else.
+
+GAME_LIST_TTL = 2  # Seconds a fetched upstream game list is reused for joining spectators
+
+
+class RelayedGame:
+    # Mirror of an upstream game, built from its snapshot and kept current with its deltas.
+    # Stands in for ChessGame wherever the server sends a snapshot (join, resync).
+    def __init__(self, state):
+        self.apply_update(state)
+
+    def apply_update(self, state):
+        self.state = state
+        self.resync_pending = False  # Set while a snapshot asked for upstream is on its way
+        self.board = chess.Board(state["fen"])
+        self.received = time.monotonic()
+
+    def apply_delta(self, delta):
+        # False when a delta was missed, the mirror then needs a fresh snapshot
+        if delta["seq"] != self.state["seq"] + 1:
+            return False
+        if delta["move"]:
+            self.board.push_uci(delta["move"])
+            self.state["move_history"].append(delta["move"])
+            self.state["fen"] = None  # Rebuilt when a snapshot is next asked for
+        for key, value in delta.items():
+            if key != "move":
+                self.state[key] = value
+        self.received = time.monotonic()
+        return True
+
+    def is_game_over(self):
+        return self.state["is_game_over"]
+
+    def get_game_state(self):
+        state = dict(self.state)
+        if state["fen"] is None:
+            state["fen"] = self.state["fen"] = self.board.fen()
+        if not state["is_game_over"]:
+            # The clocks are as of the last update, run the side to move down since then
+            elapsed = max(0, time.monotonic() - self.received - state["delay"])
+            key = "white_time" if state["turn"] == "white" else "black_time"
+            state[key] = max(0, round(state[key] - elapsed, 3))
+        return state
+
+
+class RelayServer(AsyncChessServer):
+    def __init__(self, upstream_host, upstream_port, host='0.0.0.0', port=5555, backlog=4096, protocol="binary",
+                 high_water=None, evict_after=EVICT_AFTER, metrics_port=None):
+        super().__init__(host, port, backlog, high_water=high_water, evict_after=evict_after, metrics_port=metrics_port)
+        self.upstream = (upstream_host, upstream_port)
+        self.upstream_codec = CODECS[protocol]
+        self.subscriptions = {}  # game_id: {"upstream": StreamClient or None, "ready": asyncio.Future (bool), "task": asyncio.Task}
+        self.game_list = []
+        self.game_list_fetch = None  # asyncio.Task fetching the upstream game list
+        self.game_list_fetched = 0  # time.monotonic() of the last fetch
+
+    async def open_upstream(self):
+        reader, writer = await asyncio.open_connection(*self.upstream)
+        upstream = StreamClient(writer)
+        upstream.codec = self.upstream_codec
+        writer.write(json.dumps({"type": "spectator", "protocol": upstream.codec.name}).encode() + b"\n")
+        return reader, upstream
+
+    async def fetch_game_list(self):
+        reader, upstream = await self.open_upstream()
+        try:
+            async for message in self.read_messages(reader, upstream.codec.decoder()):
+                if message.get("action") == "game_list":
+                    # Picking no game ends the connection quietly on the upstream side
+                    upstream.send(upstream.codec.encode({"game_id": None}))
+                    return message["games"]
+            raise ConnectionError("Upstream closed before sending the game list")
+        finally:
+            upstream.close()
+
+    async def refresh_game_list(self):
+        # A crowd of spectators joining at once shares one upstream request
+        if self.game_list_fetch is None or (self.game_list_fetch.done() and time.monotonic() - self.game_list_fetched > GAME_LIST_TTL):
+            self.game_list_fetch = asyncio.create_task(self.fetch_game_list())
+        try:
+            self.game_list = await asyncio.shield(self.game_list_fetch)
+        except Exception as e:
+            log.warning("Could not fetch the game list from %s:%d: %s", *self.upstream, e)
+        self.game_list_fetched = time.monotonic()
+
+    def send_game_list(self, client_socket):
+        self.send(client_socket, {"action": "game_list", "games": sorted(set(self.game_list) | set(self.games))})
+
+    async def subscribe(self, game_id):
+        # One upstream connection per game, however many local spectators watch it.
+        # True once the game's first snapshot has arrived.
+        if not isinstance(game_id, int):
+            return False
+        subscription = self.subscriptions.get(game_id)
+        if subscription is None:
+            subscription = self.subscriptions[game_id] = {"upstream": None, "ready": asyncio.get_running_loop().create_future(), "task": None}
+            subscription["task"] = asyncio.create_task(self.follow(game_id, subscription))
+        return await asyncio.shield(subscription["ready"])
+
+    async def follow(self, game_id, subscription):
+        upstream = None
+        try:
+            reader, upstream = await self.open_upstream()
+            subscription["upstream"] = upstream
+            async for message in self.read_messages(reader, upstream.codec.decoder()):
+                action = message.get("action")
+                if action == "game_list":
+                    upstream.send(upstream.codec.encode({"game_id": game_id}))
+                elif action == "update":
+                    self.relay_update(game_id, message["state"], subscription)
+                elif action == "delta":
+                    self.relay_delta(game_id, message, upstream)
+                elif action in ("chat", "opponent_disconnected") and game_id in self.games:
+                    with self.game_locks[game_id]:
+                        self.broadcast(game_id, message)
+        except Exception as e:
+            log.info("Lost upstream of game %s: %s", game_id, e)
+        finally:
+            if not subscription["ready"].done():
+                subscription["ready"].set_result(False)
+            if upstream is not None:
+                upstream.close()
+            self.drop_game(game_id, subscription)
+
+    def relay_update(self, game_id, state, subscription):
+        with self.lock:
+            if game_id not in self.games:
+                self.game_locks[game_id] = threading.Lock()
+                self.players[game_id] = {chess.WHITE: None, chess.BLACK: None}
+                self.spectators[game_id] = set()
+                self.games[game_id] = RelayedGame(state)
+                subscription["ready"].set_result(True)
+                return
+        with self.game_locks[game_id]:
+            self.games[game_id].apply_update(state)
+            self.broadcast_game_state(game_id)
+
+    def relay_delta(self, game_id, message, upstream):
+        if game_id not in self.games:
+            return
+        with self.game_locks[game_id]:
+            game = self.games[game_id]
+            if game.resync_pending:
+                return  # Superseded by the snapshot on its way
+            if game.apply_delta(message["delta"]):
+                self.broadcast(game_id, message)
+            else:
+                game.resync_pending = True
+                upstream.send(upstream.codec.encode({"action": "resync", "game_id": game_id}))
+
+    def drop_game(self, game_id, subscription):
+        # The upstream game is gone or nobody here watches it any more. Local spectators are
+        # disconnected and may join again, which subscribes afresh.
+        with self.lock:
+            if self.subscriptions.get(game_id) is not subscription:
+                return
+            del self.subscriptions[game_id]
+            spectators = self.spectators.pop(game_id, set())
+            self.games.pop(game_id, None)
+            self.players.pop(game_id, None)
+            self.game_locks.pop(game_id, None)
+        for client in spectators:
+            client.close()
+
+    def release(self, game_id):
+        # Stops following a game once its last local spectator has gone
+        subscription = self.subscriptions.get(game_id)
+        if subscription is not None and not self.spectators.get(game_id):
+            subscription["task"].cancel()
+            self.drop_game(game_id, subscription)
+
+    def disconnect_client(self, client_socket):
+        game_id = self.clients.get(client_socket, {}).get("game_id")
+        super().disconnect_client(client_socket)
+        self.release(game_id)
+
+    def process_spectator_message(self, client_socket, game_id, message):
+        super().process_spectator_message(client_socket, game_id, message)
+        subscription = self.subscriptions.get(game_id)
+        if message.get("action") == "chat" and subscription is not None and subscription["upstream"] is not None:
+            upstream = subscription["upstream"]
+            upstream.send(upstream.codec.encode({"action": "chat", "message": message["message"]}))
+
+    async def serve_player(self, client, reader, decoder, initial_message):
+        self.send(client, {"action": "error", "message": "This server only relays games to spectators"})
+
+    async def serve_spectator(self, client, reader, decoder):
+        await self.refresh_game_list()
+        self.send_game_list(client)
+        await self.spectate(client, self.read_messages(reader, decoder))
+
+    async def spectate(self, client, messages):
+        message = await messages.__anext__()
+        game_id = message.get("game_id")
+        subscribed = await self.subscribe(game_id)
+        if subscribed and client in self.clients and self.join_spectator(client, game_id):
+            async for message in messages:
+                self.process_spectator_message(client, game_id, message)
+        elif subscribed:
+            self.release(game_id)  # The spectator left while the game was being subscribed
+
+    async def accept_connections(self):
+        log.info("Relaying games from %s:%d", *self.upstream)
+        await super().accept_connections()
@@ -3,201 +3,711 @@ import threading
 import json
 import chess
 import time
-from chess_logic import ChessGame
+import argparse
+import logging
+from chess_logic import ChessGame, MAX_LAG_COMPENSATION, HOT_BOARDS, now_ms
+from timers import TimerHeap
+from connection import ClientConnection, SlowConsumerError, HIGH_WATER, EVICT_AFTER
+from protocol import JSON, CODECS, ProtocolError
+from metrics import Metrics, SamplingProfiler, serve_metrics
+from matchmaking import Matchmaker, PAIRING_INTERVAL, parse_time_control
+from archive import GameArchive
+
+log = logging.getLogger("chess_server")
+
+PING_INTERVAL = 5  # Seconds between round trip probes of every player in a game
+
 
 class ChessServer:
-    def __init__(self, host='0.0.0.0', port=5555):
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.bind((host, port))
-        self.server.listen(10)
-        print("Server started on port 5555...")
+    def __init__(self, host='0.0.0.0', port=5555, time_control=None, store=None, high_water=None, evict_after=EVICT_AFTER,
+                 metrics_port=None, pools=None):
+        self.host = host
+        self.port = port
+        self.time_control = time_control or {"initial_time": 600, "increment": 0, "delay": 0}
+        self.store = store  # Optional GameStore, games survive a restart when set
         self.games = {}  # game_id: ChessGame
-        self.clients = {}  # client_socket: {"type": "player"/"spectator", "game_id": int, "color": bool, "addr": tuple}
-        self.lobby = []  # List of waiting players
+        self.finished = set()  # game_ids of the games in self.games that are over
+        self.archive = GameArchive()  # Finished games nobody is attached to, still shown to late spectators
+        self.clients = {}  # client_socket: {"type": "player"/"spectator", "game_id": int, "color": bool, "addr": tuple, "rtt": ms or None, "ping": ms or None}
+        # Waiting players, one pool per time control: the server's own and any extra --pools
+        self.matchmaker = Matchmaker([self.time_control, *(pools or [])], self.time_control)
         self.game_counter = 0
+        # Guards clients, matchmaker and game creation. Each game's moves, clock and audience are
+        # guarded by its own lock in game_locks so games never contend with each other.
+        # Lock order: self.lock before a game lock, never the other way around.
         self.lock = threading.Lock()
+        self.game_locks = {}  # game_id: threading.Lock
+        # Index of each game's audience so fan-out never scans self.clients
+        self.players = {}  # game_id: {chess.WHITE: client_socket or None, chess.BLACK: client_socket or None}
+        self.spectators = {}  # game_id: set of client sockets
+        self.timers = TimerHeap()  # game_id: flag-fall deadline, shared by every game
+        self.timer_condition = threading.Condition()  # Guards self.timers, wakes the clock thread
+        # Outbound queue limits per client type, players get more room than spectators
+        self.high_water = dict(HIGH_WATER, **(high_water or {}))
+        self.evict_after = evict_after
+        self.outbound_stats = {"snapshots": 0, "evictions": 0}  # Snapshots sent in place of dropped frames, slow clients dropped
+        self.metrics_port = metrics_port  # Local port for /metrics and /profile, off when None
+        self.metrics = Metrics()
+        self.profiler = SamplingProfiler()
+        self.register_metrics()
+
+    def register_metrics(self):
+        # Histograms and counters are updated on the hot paths, gauges are read when scraped
+        metrics = self.metrics
+        self.move_seconds = metrics.histogram("chess_move_validation_seconds", "Time to validate and apply a move")
+        self.lock_wait_seconds = metrics.histogram("chess_game_lock_wait_seconds", "Time a move waited for its game's lock")
+        self.broadcast_seconds = metrics.histogram("chess_broadcast_seconds", "Time to encode and queue one message for a game's audience")
+        self.clock_drift_seconds = metrics.histogram("chess_clock_drift_seconds", "How far from its deadline a flag-fall timer fired")
+        self.matchmaking_wait_seconds = metrics.histogram("chess_matchmaking_wait_seconds", "Time a player waited for an opponent",
+                                                          (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+        self.moves = metrics.counter("chess_moves_total", "Moves accepted")
+        self.rejected_moves = metrics.counter("chess_moves_rejected_total", "Moves rejected")
+        self.bytes_in = metrics.counter("chess_bytes_received_total", "Bytes read from clients")
+        self.bytes_out = metrics.counter("chess_bytes_sent_total", "Bytes queued for clients")
+        metrics.counter("chess_snapshots_coalesced_total", "Snapshots sent in place of frames dropped by a full queue",
+                        lambda: self.outbound_stats["snapshots"])
+        metrics.counter("chess_slow_clients_evicted_total", "Clients dropped for a saturated outbound queue",
+                        lambda: self.outbound_stats["evictions"])
+        metrics.gauge("chess_games", "Games in progress", lambda: sum(not game.is_game_over() for game in list(self.games.values())))
+        metrics.gauge("chess_clients", "Connected clients", lambda: len(self.clients))
+        metrics.gauge("chess_spectators", "Clients watching a game", lambda: sum(len(audience) for audience in list(self.spectators.values())))
+        metrics.gauge("chess_archived_games", "Finished games moved to the archive", lambda: len(self.archive))
+        metrics.gauge("chess_hot_boards", "Games with a built chess.Board", lambda: len(ChessGame.boards))
+        metrics.gauge("chess_lobby_size", "Players waiting for an opponent", lambda: len(self.matchmaker))
+        metrics.gauge("chess_outbound_queued_bytes", "Bytes waiting in outbound queues",
+                      lambda: sum(getattr(client, "queued_bytes", 0) for client in list(self.clients)))
+
+    def start_metrics(self):
+        if self.metrics_port is not None:
+            serve_metrics(self.metrics, self.profiler, port=self.metrics_port, connections=self.connection_stats)
+            log.info("Metrics on http://127.0.0.1:%d/metrics", self.metrics_port)
+
+    def read_initial_message(self, client_socket):
+        # The first message is always a JSON line. It may switch the connection to another
+        # codec, so anything received after the newline is handed to that codec's decoder.
+        buffer = bytearray()
+        while b"\n" not in buffer:
+            data = client_socket.recv(1024)
+            if not data:
+                raise ConnectionError("Connection closed before the initial message")
+            buffer += data
+        end = buffer.index(b"\n")
+        initial_message = json.loads(buffer[:end])
+        client_socket.codec = self.select_codec(initial_message)
+        return initial_message, client_socket.codec.decoder(buffer[end + 1:])
+
+    @staticmethod
+    def select_codec(initial_message):
+        protocol = initial_message.get("protocol", JSON.name)
+        if protocol not in CODECS:
+            log.warning("Unknown protocol %r requested, using JSON", protocol)
+        return CODECS.get(protocol, JSON)
+
+    def read_messages(self, client_socket, decoder):
+        # Yields decoded messages until the peer closes the connection, starting with any the
+        # decoder already holds (sent in the same packet as the initial message)
+        yield from decoder.feed(b"")
+        while True:
+            data = client_socket.recv(4096)
+            if not data:
+                return
+            self.bytes_in.inc(len(data))
+            yield from decoder.feed(data)
+
+    def send(self, client_socket, message):
+        # A frame dropped by a full queue is made up for by the snapshot that follows it
+        try:
+            self.bytes_out.inc(client_socket.send(client_socket.codec.encode(message)))
+        except SlowConsumerError as e:
+            self.evicted(client_socket, e)
+        except ProtocolError as e:
+            log.warning("Cannot send %s to %s: %s", message.get("action"), self.clients.get(client_socket, {}).get("addr"), e)
+
+    def register_client(self, client_socket, client_type, addr):
+        with self.lock:
+            self.clients[client_socket] = {"type": client_type, "game_id": None, "color": None, "addr": addr, "rtt": None, "ping": None}
+            self.set_queue_limits(client_socket, client_type)
+
+    def set_queue_limits(self, client_socket, client_type):
+        client_socket.high_water = self.high_water.get(client_type, self.high_water["spectator"])
+        client_socket.evict_after = self.evict_after
+
+    def evicted(self, client_socket, reason):
+        # The connection has already been aborted, its reader sees EOF and disconnects it
+        self.outbound_stats["evictions"] += 1
+        log.warning("Dropped slow client %s: %s", self.clients.get(client_socket, {}).get("addr"), reason)
 
     def handle_client(self, client_socket, addr):
         try:
-            data = client_socket.recv(1024).decode()
-            initial_message = json.loads(data)
+            initial_message, decoder = self.read_initial_message(client_socket)
             client_type = initial_message.get("type", "player")
-            with self.lock:
-                self.clients[client_socket] = {"type": client_type, "game_id": None, "color": None, "addr": addr}
+            self.register_client(client_socket, client_type, addr)
 
             if client_type == "player":
-                self.handle_player(client_socket)
+                self.handle_player(client_socket, decoder, initial_message)
             else:
-                self.handle_spectator(client_socket)
+                self.handle_spectator(client_socket, decoder)
         except Exception as e:
-            print(f"Error with client {addr}: {e}")
+            log.info("Error with client %s: %s", addr, e)
         finally:
-            self.disconnect_client(client_socket)
+            if client_socket in self.clients:
+                self.disconnect_client(client_socket)
+            else:
+                client_socket.close()  # Gone or rejected before registering, the writer thread still has to stop
 
-    def handle_player(self, client_socket):
+    def join_lobby(self, client_socket, hello):
+        # The initial message may ask for a time control pool and give the player's rating
+        pool = self.matchmaker.pool_for(hello)
+        if pool is None:
+            pool = self.matchmaker.default
+            self.send(client_socket, {"action": "error", "message": f"Unknown time control {hello['time_control']}, "
+                                                                     f"joining the {pool} pool (pools: {', '.join(self.matchmaker.pools)})"})
         with self.lock:
-            self.lobby.append(client_socket)
-            print(f"Player added to lobby. Lobby size: {len(self.lobby)}")
-            if len(self.lobby) >= 2:
-                player1 = self.lobby.pop(0)
-                player2 = self.lobby.pop(0)
-                self.start_game(player1, player2)
-
-        buffer = ""
-        while True:
+            self.matchmaker.enqueue(client_socket, hello.get("rating"), pool)
+            log.debug("Player added to lobby. Lobby size: %d", len(self.matchmaker))
+
+    def pair_players(self):
+        # One matchmaking tick, games start in batches however many players joined since the last
+        if len(self.matchmaker) < 2:
+            return
+        now = time.monotonic()
+        with self.lock:
+            for white, black in self.matchmaker.pair(now):
+                game_id = self.game_counter + 1
+                try:
+                    self.start_game(white["player"], black["player"], time_control=self.matchmaker.time_controls[white["pool"]])
+                except Exception as e:
+                    # Typically one of the two hung up while waiting. The other goes back in the
+                    # queue with its original place, the pairs after this one still start.
+                    log.info("Could not start game %d: %s", game_id, e)
+                    self.abandon_game(game_id)
+                    for entry in (white, black):
+                        player = entry["player"]
+                        if player in self.clients and not player.closed:
+                            self.matchmaker.enqueue(player, entry["rating"], entry["pool"], entry["since"])
+                        else:
+                            player.close()  # Its reader disconnects it
+                    continue
+                self.matchmaking_wait_seconds.observe(now - white["since"])
+                self.matchmaking_wait_seconds.observe(now - black["since"])
+
+    def abandon_game(self, game_id):
+        # Undoes whatever a failed start_game got done, expects self.lock to be held
+        for client in self.players.pop(game_id, {}).values():
+            info = self.clients.get(client)
+            if info is not None and info["game_id"] == game_id:
+                info.update(game_id=None, color=None)
+        game = self.games.pop(game_id, None)
+        self.game_locks.pop(game_id, None)
+        self.spectators.pop(game_id, None)
+        self.finished.discard(game_id)
+        with self.timer_condition:
+            self.timers.cancel(game_id)
+        if game is not None:
+            ChessGame.boards.discard(game)
+            if self.store is not None:
+                self.store.retire(game_id)
+
+    def process_player_message(self, client_socket, message):
+        action = message.get("action")
+        game_id = message.get("game_id") or self.clients[client_socket]["game_id"]
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Received from %s: %s", self.clients[client_socket]["addr"], message)
+
+        if action == "move" and game_id in self.games:
+            waited = time.perf_counter()
+            with self.game_locks[game_id]:
+                started = time.perf_counter()
+                self.lock_wait_seconds.observe(started - waited)
+                game = self.games[game_id]
+                seq = game.seq
+                success, reason = game.make_move(message["move"], message.get("think_ms"))
+                self.move_seconds.observe(time.perf_counter() - started)
+                (self.moves if success else self.rejected_moves).inc()
+                log.debug("Move processed: %s, Success: %s, Reason: %s", message["move"], success, reason)
+                if game.seq != seq:
+                    # A move, or a flag fall detected while validating it
+                    self.schedule_flag(game_id)
+                    self.persist_change(game_id)
+                    self.broadcast_delta(game_id)
+                if not success:
+                    self.send(client_socket, {"action": "error", "message": reason})
+        elif action == "chat":
+            self.broadcast_chat(game_id, message["message"], client_socket)
+        elif action == "reconnect":
+            self.handle_reconnection(client_socket, message.get("game_id"), message.get("color"))
+        elif action == "resync" and game_id in self.games:
+            with self.game_locks[game_id]:
+                self.send_game_state(client_socket, game_id)
+        elif action == "pong":
+            self.record_rtt(client_socket, message.get("t"))
+        elif action == "stats":
+            self.send_stats(client_socket)
+
+    def send_stats(self, client_socket):
+        # Same text as /metrics, for deployments without the HTTP endpoint
+        self.send(client_socket, {"action": "stats", "metrics": self.metrics.render()})
+
+    def send_pings(self):
+        # Each ping carries the server's clock, the pong echoes it back. The player is also
+        # told its last round trip time so its clock display can allow for transit.
+        now = now_ms()
+        with self.lock:
+            players = [(client, info["rtt"]) for client, info in self.clients.items()
+                       if info["type"] == "player" and info["game_id"] is not None]
+            for client, _ in players:
+                self.clients[client]["ping"] = now  # Only a pong echoing this counts
+        for client, rtt in players:
             try:
-                data = client_socket.recv(1024).decode()
-                if not data:
-                    break
-                buffer += data
-                while buffer:
-                    try:
-                        message_end = buffer.find("\n")
-                        if message_end == -1:
-                            break
-                        message_str = buffer[:message_end].strip()
-                        buffer = buffer[message_end + 1:].strip()
-                        if message_str:
-                            message = json.loads(message_str)
-                            action = message.get("action")
-                            game_id = message.get("game_id", self.clients[client_socket]["game_id"])
-                            print(f"Received from {self.clients[client_socket]['addr']}: {message}")
-
-                            if action == "move" and game_id in self.games:
-                                with self.lock:
-                                    success, reason = self.games[game_id].make_move(message["move"])
-                                    print(f"Move processed: {message['move']}, Success: {success}, Reason: {reason}")
-                                    if success:
-                                        self.broadcast_game_state(game_id)
-                                    else:
-                                        client_socket.send(json.dumps({"action": "error", "message": reason}).encode() + b"\n")
-                            elif action == "chat":
-                                self.broadcast_chat(game_id, message["message"], client_socket)
-                            elif action == "reconnect":
-                                self.handle_reconnection(client_socket, message.get("game_id"))
-                    except json.JSONDecodeError as e:
-                        print(f"JSON decode error: {e}, Buffer: {buffer[:50]}...")
-                        if not buffer.strip():
-                            break
-                        continue
+                self.send(client, {"action": "ping", "t": now, "rtt": rtt})
             except Exception as e:
-                print(f"Error in handle_player: {e}")
-                break
+                log.debug("Failed to ping %s: %s", self.clients.get(client, {}).get("addr"), e)
+
+    def record_rtt(self, client_socket, sent_at):
+        # Smoothed round trip time of a player's connection, it bounds the lag compensation
+        # the player's moves get. Only a pong echoing the connection's outstanding ping counts,
+        # so a client cannot claim a longer round trip than it has.
+        now = now_ms()
+        with self.lock:
+            info = self.clients[client_socket]
+            if not isinstance(sent_at, int) or sent_at != info["ping"]:
+                return
+            info["ping"] = None
+            rtt = info["rtt"] = now - sent_at if info["rtt"] is None else (3 * info["rtt"] + now - sent_at) // 4
+            game_id = info["game_id"]
+            if info["type"] == "player" and game_id in self.games:
+                with self.game_locks[game_id]:
+                    if self.players[game_id].get(info["color"]) is client_socket:
+                        self.games[game_id].lag_allowance[info["color"]] = min(MAX_LAG_COMPENSATION, rtt)
+                        self.schedule_flag(game_id)
+
+    def enter_game(self, client_socket, initial_message):
+        # A reconnecting player names its game in the initial message and skips the lobby
+        if initial_message.get("action") == "reconnect":
+            self.handle_reconnection(client_socket, initial_message.get("game_id"), initial_message.get("color"))
+        else:
+            self.join_lobby(client_socket, initial_message)
+
+    def handle_player(self, client_socket, decoder, initial_message):
+        self.enter_game(client_socket, initial_message)
+        try:
+            for message in self.read_messages(client_socket, decoder):
+                self.process_player_message(client_socket, message)
+        except Exception as e:
+            log.info("Error in handle_player: %s", e)
 
-    def start_game(self, player1, player2):
-        self.game_counter += 1
-        game_id = self.game_counter
-        self.games[game_id] = ChessGame()
+    def start_game(self, player1, player2, game_id=None, time_control=None):
+        if game_id is None:
+            self.game_counter += 1
+            game_id = self.game_counter
+        time_control = time_control or self.time_control
+        self.game_locks[game_id] = threading.Lock()
+        self.players[game_id] = {chess.WHITE: player1, chess.BLACK: player2}
+        self.spectators[game_id] = set()
+        self.games[game_id] = ChessGame(**time_control)
+        if self.store is not None:
+            self.store.create_game(game_id, time_control)
         self.clients[player1]["game_id"] = game_id
         self.clients[player1]["color"] = chess.WHITE
         self.clients[player2]["game_id"] = game_id
         self.clients[player2]["color"] = chess.BLACK
 
-        player1.send(json.dumps({"action": "start", "color": "white", "game_id": game_id}).encode() + b"\n")
-        player2.send(json.dumps({"action": "start", "color": "black", "game_id": game_id}).encode() + b"\n")
-        self.broadcast_game_state(game_id)
+        self.send(player1, {"action": "start", "color": "white", "game_id": game_id})
+        self.send(player2, {"action": "start", "color": "black", "game_id": game_id})
+        with self.game_locks[game_id]:
+            self.broadcast_game_state(game_id)
+            self.start_clock(game_id)
 
-        threading.Thread(target=self.timer_thread, args=(game_id,)).start()
+    def start_clock(self, game_id):
+        self.games[game_id].start_clock()
+        self.schedule_flag(game_id)
 
-    def handle_spectator(self, client_socket):
-        client_socket.send(json.dumps({"action": "game_list", "games": list(self.games.keys())}).encode() + b"\n")
-        data = client_socket.recv(1024).decode()
-        message = json.loads(data)
-        game_id = message.get("game_id")
-        if game_id in self.games:
-            with self.lock:
+    def schedule_flag(self, game_id):
+        # Only the moment the side to move would run out of time is scheduled, idle games cost nothing
+        deadline = self.games[game_id].flag_deadline()
+        with self.timer_condition:
+            if deadline is None:
+                self.timers.cancel(game_id)
+            else:
+                self.timers.schedule(game_id, deadline)
+            self.timer_condition.notify()
+
+    def flag_expired(self, game_id):
+        if game_id not in self.games:
+            return
+        with self.game_locks[game_id]:
+            deadline = self.games[game_id].flag_deadline()
+            if deadline is not None:
+                self.clock_drift_seconds.observe(abs(time.monotonic() - deadline))
+            if self.games[game_id].check_flag():
+                self.persist_change(game_id)
+                self.broadcast_delta(game_id)
+            else:
+                # Woke up marginally early
+                self.schedule_flag(game_id)
+
+    def persist_change(self, game_id):
+        # Only enqueues, the store's writer thread does the disk I/O. Expects the game's lock to be held.
+        if self.store is not None:
+            game = self.games[game_id]
+            if game.flagged is not None:
+                self.store.append_flag(game_id, game)
+            else:
+                self.store.append_move(game_id, game)
+
+    def recover_games(self):
+        # Rebuilds the games persisted before a restart, their players get back in with "reconnect"
+        if self.store is None:
+            return
+        recovered = self.store.load()
+        with self.lock:
+            for game_id, game in recovered.items():
+                self.game_locks[game_id] = threading.Lock()
+                self.players[game_id] = {chess.WHITE: None, chess.BLACK: None}
+                self.spectators[game_id] = set()
+                self.games[game_id] = game
+                if game.is_game_over():
+                    self.finished.add(game_id)
+                with self.game_locks[game_id]:
+                    self.start_clock(game_id)
+            # Retired games are gone from the store, but their ids must not be handed out again
+            self.game_counter = max([self.game_counter, self.store.highest_retired, *recovered])
+        log.info("Recovered %d games", len(recovered))
+
+    def send_game_list(self, client_socket):
+        self.send(client_socket, {"action": "game_list", "games": list(self.games.keys())})
+
+    def join_spectator(self, client_socket, game_id):
+        with self.lock:
+            if game_id in self.games:
                 self.clients[client_socket]["game_id"] = game_id
-                self.broadcast_game_state(game_id)
+                with self.game_locks[game_id]:
+                    self.spectators[game_id].add(client_socket)
+                    self.send_game_state(client_socket, game_id)
+                return True
+        # An archived game only has its final position to show, the spectator stays connected
+        # on it without joining any audience
+        state = self.archive.get(game_id) if isinstance(game_id, int) else None
+        if state is None:
+            return False
+        with self.lock:
+            self.clients[client_socket]["game_id"] = game_id
+        self.send(client_socket, {"action": "update", "state": state})
+        return True
+
+    def process_spectator_message(self, client_socket, game_id, message):
+        action = message.get("action")
+        if action == "chat":
+            self.broadcast_chat(game_id, message["message"], client_socket)
+        elif action == "resync" and game_id in self.games:
+            with self.game_locks[game_id]:
+                self.send_game_state(client_socket, game_id)
+        elif action == "stats":
+            self.send_stats(client_socket)
+
+    def handle_spectator(self, client_socket, decoder):
+        self.send_game_list(client_socket)
+        messages = self.read_messages(client_socket, decoder)
+        message = next(messages)
+        game_id = message.get("game_id")
+        if self.join_spectator(client_socket, game_id):
             # Keep spectator active to receive updates
-            buffer = ""
-            while True:
-                try:
-                    data = client_socket.recv(1024).decode()
-                    if not data:
-                        break
-                    buffer += data
-                    while buffer:
-                        try:
-                            message_end = buffer.find("\n")
-                            if message_end == -1:
-                                break
-                            message_str = buffer[:message_end].strip()
-                            buffer = buffer[message_end + 1:].strip()
-                            if message_str:
-                                message = json.loads(message_str)
-                                action = message.get("action")
-                                if action == "chat":
-                                    self.broadcast_chat(game_id, message["message"], client_socket)
-                        except json.JSONDecodeError as e:
-                            print(f"JSON decode error: {e}, Buffer: {buffer[:50]}...")
-                            if not buffer.strip():
-                                break
-                            continue
-                except Exception as e:
-                    print(f"Error in handle_spectator: {e}")
-                    break
+            try:
+                for message in messages:
+                    self.process_spectator_message(client_socket, game_id, message)
+            except Exception as e:
+                log.info("Error in handle_spectator: %s", e)
+
+    def handle_reconnection(self, client_socket, game_id, requested_color=None):
+        with self.lock:
+            if game_id in self.games:
+                # Take the seat the client asks for, replacing whatever connection still holds
+                # it (the player's own, dropped without the server noticing yet). Without a
+                # request, whichever seat is free; a seat is never shared. Seats only change
+                # under self.lock, so they can be read here before the game's lock is taken.
+                seats = self.players[game_id]
+                color = {"white": chess.WHITE, "black": chess.BLACK}.get(requested_color)
+                if color is None:
+                    color = next((seat for seat in (chess.BLACK, chess.WHITE) if seats[seat] in (None, client_socket)), None)
+                if color is None:
+                    self.send(client_socket, {"action": "error", "message": f"Game {game_id} has no free seat"})
+                    return
+                self.matchmaker.cancel(client_socket)
+                self.leave_game(client_socket)
+                with self.game_locks[game_id]:
+                    stale = seats[color]
+                    if stale is not None:
+                        # Its reader disconnects it without telling the game it left
+                        self.clients[stale].update(game_id=None, color=None)
+                        if not stale.closed:
+                            self.send(stale, {"action": "error", "message": f"Replaced by a new connection to game {game_id}"})
+                            stale.close()
+                    seats[color] = client_socket
+                    self.clients[client_socket]["game_id"] = game_id
+                    self.clients[client_socket]["type"] = "player"
+                    self.clients[client_socket]["color"] = color
+                    self.set_queue_limits(client_socket, "player")
+                    # The old connection's round trip time no longer applies
+                    self.games[game_id].lag_allowance[color] = min(MAX_LAG_COMPENSATION, self.clients[client_socket]["rtt"] or 0)
+                    self.send(client_socket, {"action": "reconnected", "game_id": game_id, "color": "white" if color == chess.WHITE else "black"})
+                    self.send_game_state(client_socket, game_id)
+                return
+        # A game that ended and was archived meanwhile can only show its final position
+        state = self.archive.get(game_id) if isinstance(game_id, int) else None
+        if state is None:
+            self.send(client_socket, {"action": "error", "message": f"Game {game_id} not found"})
+            return
+        color = {"white": chess.WHITE, "black": chess.BLACK}.get(requested_color, chess.WHITE)
+        with self.lock:
+            self.matchmaker.cancel(client_socket)
+            self.leave_game(client_socket)
+            self.clients[client_socket].update(game_id=game_id, type="player", color=color)
+        self.send(client_socket, {"action": "reconnected", "game_id": game_id, "color": "white" if color == chess.WHITE else "black"})
+        self.send(client_socket, {"action": "update", "state": state})
 
-    def handle_reconnection(self, client_socket, game_id):
+    def leave_game(self, client_socket):
+        # Removes a client from its game's audience index, expects self.lock to be held
+        info = self.clients[client_socket]
+        game_id = info["game_id"]
+        if game_id not in self.games:
+            return False
+        with self.game_locks[game_id]:
+            if info["type"] == "player":
+                if self.players[game_id].get(info["color"]) is client_socket:
+                    self.players[game_id][info["color"]] = None
+            else:
+                self.spectators[game_id].discard(client_socket)
+        return True
+
+    def audience(self, game_id):
+        # Players first, then spectators. Expects the game's lock to be held.
+        return [client for client in self.players[game_id].values() if client is not None] + list(self.spectators[game_id])
+
+    # send_game_state and the broadcast_* helpers expect the game's lock to be held. They only
+    # enqueue onto each client's non-blocking outbound queue (ClientConnection / asyncio
+    # transport), so no socket I/O ever happens under a lock and deltas stay in seq order.
+
+    def send_game_state(self, client_socket, game_id):
+        # Full snapshot, only sent on join, reconnect or when a client asks to resync
         if game_id in self.games:
-            with self.lock:
-                self.clients[client_socket]["game_id"] = game_id
-                self.clients[client_socket]["type"] = "player"
-                self.clients[client_socket]["color"] = chess.WHITE if len([c for c, info in self.clients.items() if info["game_id"] == game_id and info["color"] == chess.BLACK]) > 0 else chess.BLACK
-                client_socket.send(json.dumps({"action": "reconnected", "game_id": game_id, "color": "white" if self.clients[client_socket]["color"] == chess.WHITE else "black"}).encode() + b"\n")
-                self.broadcast_game_state(game_id)
+            game_state = self.games[game_id].get_game_state()
+            try:
+                self.send(client_socket, {"action": "update", "state": game_state})
+            except Exception as e:
+                log.info("Failed to send game state to %s: %s", self.clients[client_socket]["addr"], e)
 
     def broadcast_game_state(self, game_id):
         if game_id in self.games:
-            game_state = self.games[game_id].get_game_state()
-            message = json.dumps({"action": "update", "state": game_state}) + "\n"
-            for client, info in self.clients.items():
-                if info["game_id"] == game_id:
-                    print(f"Broadcasting to {info['type']} at {info['addr']} for game {game_id}")
+            self.broadcast(game_id, {"action": "update", "state": self.games[game_id].get_game_state()})
+
+    def broadcast_delta(self, game_id):
+        if game_id in self.games:
+            game = self.games[game_id]
+            self.broadcast(game_id, {"action": "delta", "delta": game.get_delta()})
+            if game.is_game_over():
+                self.finished.add(game_id)
+
+    def archive_finished_games(self):
+        # Finished games leave self.games once their players and spectators have all gone,
+        # so a long-running server only holds the games still being played or watched.
+        # Returns the archived game_ids.
+        archived = []
+        with self.lock:
+            for game_id in list(self.finished):
+                if self.spectators[game_id] or any(self.players[game_id].values()):
+                    continue
+                with self.game_locks[game_id]:
+                    game = self.games[game_id]
+                    self.archive.add(game_id, game.get_game_state())
+                del self.games[game_id], self.game_locks[game_id], self.players[game_id], self.spectators[game_id]
+                self.finished.discard(game_id)
+                if self.store is not None:
+                    self.store.retire(game_id)
+                ChessGame.boards.discard(game)
+                archived.append(game_id)
+        if archived:
+            log.debug("Archived %d finished games", len(archived))
+        return archived
+
+    def broadcast(self, game_id, payload, exclude=None):
+        # Encoded once per codec in use, the same bytes object is queued for every recipient.
+        # Players come first in the audience, so their frames are queued before the spectators'.
+        started = time.perf_counter()
+        queued = 0
+        frames = {}
+        snapshots = {}
+        recipients = self.audience(game_id)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Broadcasting %s to %d clients for game %s", payload["action"], len(recipients), game_id)
+        for client in recipients:
+            if client != exclude:
+                try:
+                    if client.needs_snapshot:
+                        # Its queue overflowed earlier, the snapshot replaces everything it missed
+                        self.send_snapshot(client, game_id, snapshots)
+                        continue
+                    frame = frames.get(client.codec)
+                    if frame is None:
+                        frame = frames[client.codec] = client.codec.encode(payload)
+                    sent = client.send(frame)
+                    queued += sent
+                    if not sent:
+                        self.send_snapshot(client, game_id, snapshots)
+                except SlowConsumerError as e:
+                    self.evicted(client, e)
+                except Exception as e:
+                    log.info("Failed to send %s to %s: %s", payload["action"], self.clients.get(client, {}).get("addr"), e)
+        self.bytes_out.inc(queued)
+        self.broadcast_seconds.observe(time.perf_counter() - started)
+
+    def send_snapshot(self, client_socket, game_id, snapshots):
+        # Coalesces a slow client's dropped frames into one full snapshot, encoded once per
+        # codec per broadcast. Expects the game's lock to be held.
+        frame = snapshots.get(client_socket.codec)
+        if frame is None:
+            frame = snapshots[client_socket.codec] = client_socket.codec.encode(
+                {"action": "update", "state": self.games[game_id].get_game_state()})
+        client_socket.needs_snapshot = False
+        sent = client_socket.send(frame)
+        if sent:
+            self.bytes_out.inc(sent)
+            self.outbound_stats["snapshots"] += 1
+
+    def send_pending_snapshots(self):
+        # Clients whose queue overflowed outside a broadcast get their snapshot here rather
+        # than waiting for the next move of their game
+        with self.lock:
+            pending = [(client, info["game_id"]) for client, info in self.clients.items()
+                       if client.needs_snapshot and info["game_id"] in self.games]
+            for client, game_id in pending:
+                with self.game_locks[game_id]:
                     try:
-                        client.send(message.encode())
-                    except:
-                        print(f"Failed to send update to {info['addr']}")
+                        self.send_snapshot(client, game_id, {})
+                    except SlowConsumerError as e:
+                        self.evicted(client, e)
+                    except Exception as e:
+                        log.info("Failed to send a snapshot to %s: %s", self.clients[client]["addr"], e)
+
+    def connection_stats(self):
+        # Per-connection outbound queue depth and drop counters
+        with self.lock:
+            return [dict(client.queue_stats(), addr=info["addr"], type=info["type"], game_id=info["game_id"])
+                    for client, info in self.clients.items()]
 
     def broadcast_chat(self, game_id, chat_message, sender_socket):
-        message = json.dumps({"action": "chat", "message": chat_message}) + "\n"
-        for client, info in self.clients.items():
-            if info["game_id"] == game_id and client != sender_socket:
-                try:
-                    client.send(message.encode())
-                except:
-                    print(f"Failed to send chat to {info['addr']}")
-
-    def timer_thread(self, game_id):
-        last_time = time.time()
-        while game_id in self.games and not self.games[game_id].get_game_state()["is_game_over"]:
-            current_time = time.time()
-            delta = current_time - last_time
-            last_time = current_time
-            with self.lock:
-                current_turn = chess.WHITE if self.games[game_id].board.turn == chess.WHITE else chess.BLACK
-                self.games[game_id].update_time(delta, current_turn)
-                self.broadcast_game_state(game_id)
-            time.sleep(1)
+        if game_id in self.games:
+            with self.game_locks[game_id]:
+                self.broadcast(game_id, {"action": "chat", "message": chat_message}, exclude=sender_socket)
+
+    def matchmaking_thread(self):
+        while True:
+            time.sleep(PAIRING_INTERVAL)
+            try:
+                self.pair_players()
+            except Exception:
+                log.exception("Matchmaking tick failed")  # The next tick tries again
+
+    def ping_thread(self):
+        while True:
+            time.sleep(PING_INTERVAL)
+            self.send_pings()
+            self.send_pending_snapshots()
+            self.archive_finished_games()
+
+    def clock_thread(self):
+        # Single thread for every game clock, sleeps until the earliest flag-fall deadline
+        while True:
+            with self.timer_condition:
+                deadline = self.timers.next_deadline()
+                now = time.monotonic()
+                if deadline is None or deadline > now:
+                    self.timer_condition.wait(None if deadline is None else deadline - now)
+                    continue
+                expired = self.timers.pop_due(now)
+            for game_id in expired:
+                self.flag_expired(game_id)
 
     def disconnect_client(self, client_socket):
         with self.lock:
             if client_socket in self.clients:
                 game_id = self.clients[client_socket]["game_id"]
-                if game_id in self.games and self.clients[client_socket]["type"] == "player":
-                    for client, info in self.clients.items():
-                        if info["game_id"] == game_id and client != client_socket:
-                            client.send(json.dumps({"action": "opponent_disconnected", "game_id": game_id}).encode() + b"\n")
-                if client_socket in self.lobby:
-                    self.lobby.remove(client_socket)
+                if self.leave_game(client_socket) and self.clients[client_socket]["type"] == "player":
+                    with self.game_locks[game_id]:
+                        self.broadcast(game_id, {"action": "opponent_disconnected", "game_id": game_id})
+                self.matchmaker.cancel(client_socket)
                 del self.clients[client_socket]
                 client_socket.close()
 
     def run(self):
-        while True:
-            client_socket, addr = self.server.accept()
-            print(f"New connection from {addr}")
-            threading.Thread(target=self.handle_client, args=(client_socket, addr)).start()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # A restarted server must be able to take the port back while old connections sit in TIME_WAIT
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((self.host, self.port))
+        self.server.listen(10)
+        log.info("Server started on port %d...", self.port)
+        threading.Thread(target=self.clock_thread, name="clock", daemon=True).start()
+        threading.Thread(target=self.ping_thread, name="ping", daemon=True).start()
+        threading.Thread(target=self.matchmaking_thread, name="matchmaking", daemon=True).start()
+        self.start_metrics()
+        self.recover_games()
+        try:
+            while True:
+                client_socket, addr = self.server.accept()
+                log.debug("New connection from %s", addr)
+                threading.Thread(target=self.handle_client, args=(ClientConnection(client_socket, addr), addr),
+                                 name=f"client {addr[0]}:{addr[1]}").start()
+        finally:
+            self.archive.close()
+            if self.store is not None:
+                self.store.close()
 
 if __name__ == "__main__":
-    server = ChessServer()
-    server.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Multiplayer Chess Server")
+    parser.add_argument("--host", default="0.0.0.0", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=5555, help="Port to listen on")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded", help="Server implementation (thread per connection or asyncio event loop)")
+    parser.add_argument("--shards", type=int, default=0, help="Run this many worker processes behind a front acceptor, each owning a share of the games (0 = single process)")
+    parser.add_argument("--relay", metavar="HOST:PORT", help="Run as a spectator relay for the games of this upstream server (or relay)")
+    parser.add_argument("--relay-protocol", choices=sorted(CODECS), default="binary", help="Wire format on the relay's upstream connections")
+    parser.add_argument("--time", type=float, default=600, help="Initial clock time per player in seconds")
+    parser.add_argument("--increment", type=float, default=0, help="Seconds added to the mover's clock after each move")
+    parser.add_argument("--delay", type=float, default=0, help="Seconds at the start of each turn before the clock runs")
+    parser.add_argument("--pools", nargs="+", default=[], metavar="SECONDS+INCREMENT", help="Extra time controls players can ask for in their initial message (e.g. 60+0 180+2), the --time/--increment pool is the default")
+    parser.add_argument("--data-dir", help="Persist games in this directory and recover them on restart")
+    parser.add_argument("--snapshot-every", type=int, default=20, help="Moves between compacting snapshots of a persisted game")
+    parser.add_argument("--player-high-water", type=int, default=HIGH_WATER["player"] >> 10, help="KiB a player's outbound queue may hold before it is coalesced to a snapshot")
+    parser.add_argument("--spectator-high-water", type=int, default=HIGH_WATER["spectator"] >> 10, help="KiB a spectator's outbound queue may hold before it is coalesced to a snapshot")
+    parser.add_argument("--evict-after", type=float, default=EVICT_AFTER, help="Seconds a client's queue may stay saturated before the client is dropped")
+    parser.add_argument("--hot-boards", type=int, default=HOT_BOARDS, help="Boards of recently active games kept built, about 20 KiB each; the others are replayed from their moves when needed")
+    parser.add_argument("--metrics-port", type=int, help="Serve /metrics (Prometheus text) and /profile on this local port (shard N uses port + N)")
+    parser.add_argument("--log-level", choices=["debug", "info", "warning", "error"], default="info", help="Logging verbosity (debug logs every message)")
+    args = parser.parse_args()
+    if args.snapshot_every < 1:
+        parser.error("--snapshot-every must be at least 1")
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(message)s")
+    time_control = {"initial_time": args.time, "increment": args.increment, "delay": args.delay}
+    pools = [parse_time_control(name, args.delay) for name in args.pools]
+    high_water = {"player": args.player_high_water << 10, "spectator": args.spectator_high_water << 10}
+    ChessGame.boards.capacity = max(1, args.hot_boards)  # Inherited by forked shards
+    store = None
+    if args.data_dir and not args.shards:
+        from store import GameStore
+        store = GameStore(args.data_dir, args.snapshot_every)
+    if args.relay:
+        from relay import RelayServer
+        upstream_host, upstream_port = args.relay.rsplit(":", 1)
+        server = RelayServer(upstream_host, int(upstream_port), args.host, args.port, protocol=args.relay_protocol,
+                             high_water=high_water, evict_after=args.evict_after, metrics_port=args.metrics_port)
+    elif args.shards:
+        # Each shard is an asyncio server with its own store under --data-dir
+        from shard import ShardedChessServer
+        server = ShardedChessServer(args.host, args.port, args.shards, time_control=time_control, data_dir=args.data_dir,
+                                    snapshot_every=args.snapshot_every, log_level=args.log_level, pools=pools,
+                                    high_water=high_water, evict_after=args.evict_after, metrics_port=args.metrics_port)
+    elif args.mode == "asyncio":
+        from async_server import AsyncChessServer
+        server = AsyncChessServer(args.host, args.port, time_control=time_control, store=store, pools=pools,
+                                  high_water=high_water, evict_after=args.evict_after, metrics_port=args.metrics_port)
+    else:
+        server = ChessServer(args.host, args.port, time_control, store, high_water, args.evict_after, args.metrics_port, pools)
+    server.run()
@@ -0,0 +1,28 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+# Local server processes for the end-to-end benchmarks (bench_load, bench_shards, bench_relay)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(*arguments):
+    # Runs server.py on a free port with the given extra arguments and returns (process, port)
+    # once it accepts connections. A sharded server only listens after every shard is up.
+    port = free_port()
+    command = [sys.executable, "server.py", "--port", str(port), "--log-level", "warning", *arguments]
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return process, port
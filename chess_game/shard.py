@@ -0,0 +1,385 @@
+import array
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+from async_server import AsyncChessServer, StreamClient, raise_fd_limit
+from connection import EVICT_AFTER
+from matchmaking import Matchmaker, PAIRING_INTERVAL
+from server import ChessServer, log
+
+# Sharded deployment: one front process accepts every connection, reads its initial message
+# and runs the matchmaking, then passes the socket itself (SCM_RIGHTS) to the worker process that
+# owns the game, game_id % shards. Workers are ordinary asyncio servers without a listening
+# socket, so move validation runs on as many cores as there are workers and no game traffic
+# ever goes through the front. Every handoff is one datagram on a SOCK_SEQPACKET socketpair:
+# a JSON header followed by the file descriptors.
+
+MAX_HANDOFF = 65536  # Largest handoff datagram, the header carries the bytes read so far
+ARCHIVED_CHUNK = 4096  # Game ids per "archived" event, keeps each well under MAX_HANDOFF
+MAX_PENDING = 4096  # Bytes a player may send while still in the lobby
+MAX_HELLO = 1024  # Longest initial message, two of them and their pending bytes fit in one handoff
+
+
+def receive_datagram(control):
+    # Returns the data, the received file descriptors and whether the data was cut short
+    fds = array.array("i")
+    data, ancdata, flags, _ = control.recvmsg(MAX_HANDOFF, socket.CMSG_LEN(2 * fds.itemsize))
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - len(cmsg_data) % fds.itemsize])
+    return data, list(fds), bool(flags & socket.MSG_TRUNC)
+
+
+class ShardWorker(AsyncChessServer):
+    def __init__(self, shard, control, time_control=None, store=None, high_water=None, evict_after=EVICT_AFTER, metrics_port=None):
+        super().__init__(time_control=time_control, store=store, high_water=high_water, evict_after=evict_after,
+                         metrics_port=metrics_port)
+        self.shard = shard
+        self.control = control  # This worker's end of the socketpair shared with the front
+
+    def notify_front(self, event):
+        self.control.send(json.dumps(event).encode())
+
+    def archive_finished_games(self):
+        # The front drops archived games from its game list
+        archived = super().archive_finished_games()
+        for start in range(0, len(archived), ARCHIVED_CHUNK):
+            self.notify_front({"op": "archived", "games": archived[start:start + ARCHIVED_CHUNK]})
+        return archived
+
+    def receive_handoff(self):
+        try:
+            data, fds, truncated = receive_datagram(self.control)
+        except BlockingIOError:
+            return
+        # Wrapped straight away so the players' sockets are closed whatever is wrong with the header
+        sockets = [socket.socket(fileno=fd) for fd in fds]
+        if not data and not sockets:
+            # The front has gone away
+            asyncio.get_running_loop().remove_reader(self.control.fileno())
+            self.stopped.set_result(None)
+            return
+        try:
+            if truncated:
+                raise ValueError(f"Handoff longer than {MAX_HANDOFF} bytes")
+            handoff = json.loads(data)
+        except ValueError as e:
+            log.error("Dropping %d connections from an unreadable handoff: %s", len(sockets), e)
+            for sock in sockets:
+                sock.close()
+            return
+        asyncio.get_running_loop().create_task(self.adopt(handoff, sockets))
+
+    async def adopt(self, handoff, sockets):
+        pending = handoff["pending"]
+        connections = []
+        for sock, hello, data in zip(sockets, handoff["hellos"], pending):
+            reader, writer = await asyncio.open_connection(sock=sock)
+            client = StreamClient(writer)
+            client.codec = self.select_codec(hello)
+            # Whatever the front read after the initial line is replayed through the codec
+            decoder = client.codec.decoder(data.encode("latin-1"))
+            self.register_client(client, hello.get("type", "player"), writer.get_extra_info("peername"))
+            connections.append((client, reader, decoder, hello))
+
+        if handoff["op"] == "start":
+            (white, _, _, _), (black, _, _, _) = connections
+            with self.lock:
+                self.start_game(white, black, handoff["game_id"], handoff["time_control"])
+            await asyncio.gather(*(self.serve_connection(client, self.play(client, reader, decoder))
+                                   for client, reader, decoder, _ in connections))
+        elif handoff["op"] == "reconnect":
+            client, reader, decoder, hello = connections[0]
+            if hello.get("action") == "reconnect":
+                self.enter_game(client, hello)
+            # Otherwise the player asked from the lobby and the request is among the pending messages
+            await self.serve_connection(client, self.play(client, reader, decoder))
+        else:
+            client, reader, decoder, _ = connections[0]
+            await self.serve_connection(client, self.spectate(client, self.read_messages(reader, decoder)))
+
+    async def play(self, client, reader, decoder):
+        async for message in self.read_messages(reader, decoder):
+            self.process_player_message(client, message)
+
+    async def serve_connection(self, client, handler):
+        try:
+            await handler
+        except Exception as e:
+            log.info("Error with client %s: %s", self.clients.get(client, {}).get("addr"), e)
+        finally:
+            self.disconnect_client(client)
+
+    async def accept_connections(self):
+        loop = asyncio.get_running_loop()
+        self.stopped = loop.create_future()
+        self.control.setblocking(False)
+        loop.add_reader(self.control.fileno(), self.receive_handoff)
+        # Lets the front route reconnects and list recovered games, and resume numbering after them
+        self.notify_front({"op": "games", "games": list(self.games), "game_counter": self.game_counter})
+        log.info("Shard %d ready (pid %d)", self.shard, os.getpid())
+        await self.stopped
+
+
+def run_worker(shard, control, time_control, data_dir, snapshot_every, log_level, high_water, evict_after, metrics_port):
+    logging.basicConfig(level=log_level.upper(), format=f"%(asctime)s %(levelname)s [shard {shard}] %(message)s", force=True)
+    store = None
+    if data_dir:
+        from store import GameStore
+        # Games are placed by game_id % shards, so the shard count must not change between restarts
+        store = GameStore(os.path.join(data_dir, f"shard-{shard}"), snapshot_every)
+    # Every worker has its own metrics, on consecutive ports
+    metrics_port = None if metrics_port is None else metrics_port + shard
+    ShardWorker(shard, control, time_control, store, high_water, evict_after, metrics_port).run()
+
+
+class ShardedChessServer:
+    def __init__(self, host='0.0.0.0', port=5555, shards=None, backlog=4096, time_control=None,
+                 data_dir=None, snapshot_every=20, log_level="info", high_water=None, evict_after=EVICT_AFTER, metrics_port=None,
+                 pools=None):
+        self.host = host
+        self.port = port
+        self.shards = shards or os.cpu_count() or 1
+        self.backlog = backlog
+        self.time_control = time_control or {"initial_time": 600, "increment": 0, "delay": 0}
+        self.data_dir = data_dir
+        self.snapshot_every = snapshot_every
+        self.log_level = log_level
+        self.high_water = high_water  # Outbound queue limits, applied by the workers
+        self.evict_after = evict_after
+        self.metrics_port = metrics_port  # First worker's metrics port
+        self.workers = []  # (process, control socket), indexed by shard
+        self.games = set()  # game_ids of the games on any shard that are not archived yet, for the spectators' game list
+        self.game_counter = 0
+        self.matchmaker = Matchmaker([self.time_control, *(pools or [])], self.time_control)  # Keyed by socket
+        self.lobby = {}  # sock: {"sock", "hello", "pending", "task"} of every waiting player
+        self.ready = None  # asyncio.Future, set once every shard has reported its games
+        self.matchmaking_task = None  # Kept so the running task is not garbage collected
+
+    def shard_of(self, game_id):
+        return game_id % self.shards
+
+    def start_workers(self):
+        # Forked rather than spawned: the worker inherits its end of the socketpair
+        context = multiprocessing.get_context("fork")
+        for shard in range(self.shards):
+            control, worker_control = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            process = context.Process(target=self.worker_main, args=(shard, control, worker_control), daemon=True)
+            process.start()
+            worker_control.close()
+            self.workers.append((process, control))
+
+    def worker_main(self, shard, control, worker_control):
+        # The fork also copied the front's ends of every socketpair, closing them lets the
+        # worker see EOF and exit as soon as the front goes away
+        control.close()
+        for _, other_control in self.workers:
+            other_control.close()
+        run_worker(shard, worker_control, self.time_control, self.data_dir, self.snapshot_every, self.log_level,
+                   self.high_water, self.evict_after, self.metrics_port)
+
+    def worker_event(self, shard):
+        control = self.workers[shard][1]
+        try:
+            data = control.recv(MAX_HANDOFF)
+        except BlockingIOError:
+            return
+        if not data:
+            log.error("Shard %d exited", shard)
+            asyncio.get_running_loop().remove_reader(control.fileno())
+            return
+        event = json.loads(data)
+        if event["op"] == "games":
+            self.games.update(event["games"])
+            self.game_counter = max([self.game_counter, event["game_counter"], *event["games"]])
+            self.reported.add(shard)
+            if len(self.reported) == self.shards and not self.ready.done():
+                self.ready.set_result(None)
+        elif event["op"] == "archived":
+            self.games.difference_update(event["games"])
+
+    def hand_off(self, game_id, op, entries, time_control=None):
+        # One datagram carries the header and every socket, the front's copies are closed afterwards.
+        # Returns False, with the sockets still open, if the shard could not be sent them.
+        header = {"op": op, "game_id": game_id, "time_control": time_control,
+                  "hellos": [entry["hello"] for entry in entries],
+                  "pending": [bytes(entry["pending"]).decode("latin-1") for entry in entries]}
+        shard = self.shard_of(game_id)
+        try:
+            socket.send_fds(self.workers[shard][1], [json.dumps(header).encode()], [entry["sock"].fileno() for entry in entries])
+        except OSError as e:
+            log.warning("Could not hand game %s over to shard %d: %s", game_id, shard, e)
+            return False
+        # Closed on the next loop iteration, after a cancelled lobby read has unregistered the fd
+        loop = asyncio.get_running_loop()
+        for entry in entries:
+            loop.call_soon(entry["sock"].close)
+        return True
+
+    async def read_hello(self, sock):
+        loop = asyncio.get_running_loop()
+        buffer = bytearray()
+        while b"\n" not in buffer:
+            if len(buffer) > MAX_HELLO:
+                break
+            data = await loop.sock_recv(sock, 1024)
+            if not data:
+                raise ConnectionError("Connection closed before the initial message")
+            buffer += data
+        end = buffer.find(b"\n")
+        if not 0 <= end <= MAX_HELLO:
+            raise ValueError(f"Initial message longer than {MAX_HELLO} bytes")
+        return json.loads(buffer[:end]), buffer[end + 1:]
+
+    async def serve_client(self, sock, addr):
+        try:
+            hello, pending = await self.read_hello(sock)
+            entry = {"sock": sock, "hello": hello, "pending": pending, "task": None}
+            if hello.get("type", "player") != "player":
+                await self.route_spectator(entry)
+            elif hello.get("action") == "reconnect":
+                game_id = hello.get("game_id")
+                if not self.hand_off(game_id if isinstance(game_id, int) else 0, "reconnect", [entry]):
+                    sock.close()
+            else:
+                await self.wait_in_lobby(entry)
+        except Exception as e:
+            log.info("Error with client %s: %s", addr, e)
+            sock.close()
+
+    async def wait_in_lobby(self, entry):
+        loop = asyncio.get_running_loop()
+        codec = ChessServer.select_codec(entry["hello"])
+        pool = self.matchmaker.pool_for(entry["hello"])
+        if pool is None:
+            pool = self.matchmaker.default
+            await loop.sock_sendall(entry["sock"], codec.encode({
+                "action": "error", "message": f"Unknown time control {entry['hello']['time_control']}, "
+                                              f"joining the {pool} pool (pools: {', '.join(self.matchmaker.pools)})"}))
+        entry["pool"] = pool
+        self.lobby[entry["sock"]] = entry
+        self.matchmaker.enqueue(entry["sock"], entry["hello"].get("rating"), pool)
+        log.debug("Player added to lobby. Lobby size: %d", len(self.lobby))
+        entry["task"] = asyncio.current_task()
+        await self.read_lobby(entry)
+
+    async def read_lobby(self, entry):
+        # Keep reading while waiting so a player who leaves is dropped from the lobby
+        loop = asyncio.get_running_loop()
+        decoder = ChessServer.select_codec(entry["hello"]).decoder(bytes(entry["pending"]))
+        data = b""
+        try:
+            while True:
+                for message in decoder.feed(data):
+                    # A waiting player may still ask to go back to a game, the shard that owns it
+                    # finds the request among the pending bytes
+                    game_id = message.get("game_id")
+                    if message.get("action") == "reconnect" and isinstance(game_id, int) and 0 < game_id <= self.game_counter:
+                        self.matchmaker.cancel(entry["sock"])
+                        del self.lobby[entry["sock"]]
+                        if not self.hand_off(game_id, "reconnect", [entry]):
+                            entry["sock"].close()
+                        return
+                data = await loop.sock_recv(entry["sock"], 4096)
+                if not data:
+                    break
+                entry["pending"] += data
+                if len(entry["pending"]) > MAX_PENDING:
+                    log.info("Dropping a player who sent %d bytes from the lobby", len(entry["pending"]))
+                    break
+        finally:
+            # A player put back in the queue after a failed handoff is read by a new task
+            if entry["task"] is asyncio.current_task() and self.matchmaker.cancel(entry["sock"]):
+                del self.lobby[entry["sock"]]
+                entry["sock"].close()
+
+    async def matchmaking_loop(self):
+        while True:
+            await asyncio.sleep(PAIRING_INTERVAL)
+            try:
+                for white, black in self.matchmaker.pair():
+                    self.start_game(self.lobby.pop(white["player"]), self.lobby.pop(black["player"]),
+                                    self.matchmaker.time_controls[white["pool"]], (white["since"], black["since"]))
+            except Exception:
+                log.exception("Matchmaking tick failed")  # The next tick tries again
+
+    def start_game(self, player1, player2, time_control, since=(None, None)):
+        self.game_counter += 1
+        game_id = self.game_counter
+        for entry in (player1, player2):
+            entry["task"].cancel()
+        if self.hand_off(game_id, "start", [player1, player2], time_control):
+            self.games.add(game_id)
+            return
+        # Both go back in the queue with their original wait, a player who has gone is
+        # dropped by its new lobby read
+        loop = asyncio.get_running_loop()
+        for entry, waiting_since in zip((player1, player2), since):
+            self.lobby[entry["sock"]] = entry
+            self.matchmaker.enqueue(entry["sock"], entry["hello"].get("rating"), entry["pool"], waiting_since)
+            entry["task"] = loop.create_task(self.rejoin_lobby(entry))
+
+    async def rejoin_lobby(self, entry):
+        # Runs after the cancelled lobby read has unregistered the socket, it was scheduled first
+        try:
+            await self.read_lobby(entry)
+        except Exception as e:
+            log.info("Error with a waiting player: %s", e)
+
+    async def route_spectator(self, entry):
+        # The front answers with the game list of every shard and hands the spectator to the
+        # shard of the game it picks. The worker decodes the pick again from "pending".
+        loop = asyncio.get_running_loop()
+        codec = ChessServer.select_codec(entry["hello"])
+        await loop.sock_sendall(entry["sock"], codec.encode({"action": "game_list", "games": sorted(self.games)}))
+        decoder = codec.decoder(bytes(entry["pending"]))
+        messages = decoder.feed(b"")
+        while not messages:
+            data = await loop.sock_recv(entry["sock"], 4096)
+            if not data:
+                raise ConnectionError("Spectator left before picking a game")
+            entry["pending"] += data
+            if len(entry["pending"]) > MAX_PENDING:
+                raise ValueError(f"Spectator sent {len(entry['pending'])} bytes without picking a game")
+            messages = decoder.feed(data)
+        game_id = messages[0].get("game_id")
+        if not isinstance(game_id, int) or not 0 < game_id <= self.game_counter:
+            entry["sock"].close()
+            return
+        # Archived games are no longer listed, but their shard still shows the final position
+        if not self.hand_off(game_id, "spectate", [entry]):
+            entry["sock"].close()
+
+    async def serve(self):
+        raise_fd_limit()
+        loop = asyncio.get_running_loop()
+        self.ready = loop.create_future()
+        self.reported = set()
+        for shard, (_, control) in enumerate(self.workers):
+            # Left blocking: handoffs are small and a worker drains its end as soon as it can
+            loop.add_reader(control.fileno(), self.worker_event, shard)
+        await self.ready
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((self.host, self.port))
+        server.listen(self.backlog)
+        server.setblocking(False)
+        log.info("Server started on port %d (%d shards)...", self.port, self.shards)
+        self.matchmaking_task = loop.create_task(self.matchmaking_loop())
+        while True:
+            sock, addr = await loop.sock_accept(server)
+            log.debug("New connection from %s", addr)
+            loop.create_task(self.serve_client(sock, addr))
+
+    def run(self):
+        # Forked before the event loop exists so the workers start from a clean process
+        self.start_workers()
+        try:
+            asyncio.run(self.serve())
+        finally:
+            for process, control in self.workers:
+                control.close()
+                process.join(5)
@@ -0,0 +1,227 @@
+import collections
+import json
+import logging
+import os
+import threading
+import chess
+from chess_logic import ChessGame
+
+log = logging.getLogger("chess_store")
+
+
+class GameStore:
+    # Durable game records: an append-only JSON-lines log per game (<game_id>.log) and a
+    # compact snapshot (<game_id>.snap) written every snapshot_every moves, after which the
+    # log is truncated. The server only enqueues records; one writer thread writes whatever
+    # has queued up and fsyncs each touched file once per batch (group commit), so
+    # persistence never blocks a move. A crash loses at most the batch being written.
+    # Finished games are retired once archived: their files are deleted and only the highest
+    # retired game_id is kept (in "retired"), so numbering resumes after it on a restart.
+    def __init__(self, directory, snapshot_every=20, max_open_files=256):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.max_open_files = max_open_files
+        os.makedirs(directory, exist_ok=True)
+        self.pending = collections.deque()  # (game_id, record)
+        self.ready = threading.Condition()
+        self.files = collections.OrderedDict()  # game_id: open log file, least recently used first
+        self.highest_retired = self.read_highest_retired()
+        self.closed = False
+        self.thread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.thread.start()
+
+    def log_path(self, game_id):
+        return os.path.join(self.directory, f"{game_id}.log")
+
+    def snapshot_path(self, game_id):
+        return os.path.join(self.directory, f"{game_id}.snap")
+
+    def retired_path(self):
+        return os.path.join(self.directory, "retired")
+
+    def read_highest_retired(self):
+        try:
+            with open(self.retired_path(), encoding="utf-8") as retired_file:
+                return int(retired_file.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def append(self, game_id, record):
+        with self.ready:
+            if self.closed:
+                raise RuntimeError("Game store is closed")
+            self.pending.append((game_id, record))
+            self.ready.notify()
+
+    def create_game(self, game_id, time_control):
+        self.append(game_id, {"op": "start", "time_control": time_control})
+
+    def append_move(self, game_id, game):
+        ply = len(game.moves)
+        self.append(game_id, {"op": "move", "ply": ply, "move": game.last_move(), "white_ms": game.white_ms, "black_ms": game.black_ms})
+        if ply % self.snapshot_every == 0:
+            self.append(game_id, self.snapshot_record(game))
+
+    def retire(self, game_id):
+        # The game is over and archived, after a restart it is no longer recovered
+        self.append(game_id, {"op": "retire"})
+
+    def append_flag(self, game_id, game):
+        self.append(game_id, {"op": "flag", "ply": len(game.moves), "color": "white" if game.flagged == chess.WHITE else "black"})
+
+    def snapshot_record(self, game):
+        return {
+            "op": "snapshot",
+            "time_control": {"initial_time": game.initial_time, "increment": game.increment, "delay": game.delay},
+            "fen": game.fen(),
+            "move_history": game.move_history,
+            "white_ms": game.white_ms,
+            "black_ms": game.black_ms,
+            "flagged": None if game.flagged is None else ("white" if game.flagged == chess.WHITE else "black")
+        }
+
+    def log_file(self, game_id):
+        log_file = self.files.pop(game_id, None)
+        if log_file is None:
+            if len(self.files) >= self.max_open_files:
+                _, oldest = self.files.popitem(last=False)
+                oldest.close()
+            log_file = open(self.log_path(game_id), "a", encoding="utf-8")
+        self.files[game_id] = log_file
+        return log_file
+
+    def write_snapshot(self, game_id, record):
+        # Written to a temporary file and renamed so a crash never leaves a torn snapshot.
+        # The log is only truncated afterwards; if we crash in between, recovery skips the
+        # log records the snapshot already covers.
+        path = self.snapshot_path(game_id)
+        with open(path + ".tmp", "w", encoding="utf-8") as snapshot_file:
+            json.dump(record, snapshot_file)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(path + ".tmp", path)
+        log_file = self.files.pop(game_id, None)
+        if log_file is not None:
+            log_file.close()
+        open(self.log_path(game_id), "w").close()
+
+    def delete_game(self, game_id):
+        log_file = self.files.pop(game_id, None)
+        if log_file is not None:
+            log_file.close()
+        if game_id > self.highest_retired:
+            # Recorded before the files go, a crash in between leaves the game to be recovered again
+            path = self.retired_path()
+            with open(path + ".tmp", "w", encoding="utf-8") as retired_file:
+                retired_file.write(str(game_id))
+                retired_file.flush()
+                os.fsync(retired_file.fileno())
+            os.replace(path + ".tmp", path)
+            self.highest_retired = game_id
+        for path in (self.log_path(game_id), self.snapshot_path(game_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def writer_loop(self):
+        while True:
+            with self.ready:
+                while not self.pending and not self.closed:
+                    self.ready.wait()
+                if not self.pending:
+                    break
+                batch = list(self.pending)
+                self.pending.clear()
+            touched = {}
+            try:
+                for game_id, record in batch:
+                    if record["op"] == "snapshot":
+                        touched.pop(game_id, None)
+                        self.write_snapshot(game_id, record)
+                    elif record["op"] == "retire":
+                        touched.pop(game_id, None)
+                        self.delete_game(game_id)
+                    else:
+                        touched[game_id] = log_file = self.log_file(game_id)
+                        log_file.write(json.dumps(record) + "\n")
+                for log_file in touched.values():
+                    log_file.flush()
+                    os.fsync(log_file.fileno())
+            except OSError as e:
+                log.error("Failed to persist %d records: %s", len(batch), e)
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+        self.thread.join()
+        for log_file in self.files.values():
+            log_file.close()
+        self.files.clear()
+
+    def read_log(self, game_id):
+        records = []
+        try:
+            with open(self.log_path(game_id), encoding="utf-8") as log_file:
+                for line in log_file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # Torn write at the tail of the log
+                        log.warning("Ignoring incomplete record in %s", self.log_path(game_id))
+                        break
+        except FileNotFoundError:
+            pass
+        return records
+
+    def load_game(self, game_id):
+        time_control = None
+        moves = []
+        white_ms = black_ms = None
+        flagged = None
+        try:
+            with open(self.snapshot_path(game_id), encoding="utf-8") as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            time_control = snapshot["time_control"]
+            moves = snapshot["move_history"]
+            white_ms, black_ms = snapshot["white_ms"], snapshot["black_ms"]
+            flagged = snapshot["flagged"]
+        except FileNotFoundError:
+            pass
+        for record in self.read_log(game_id):
+            if record["op"] == "start":
+                time_control = time_control or record["time_control"]
+            elif record["op"] == "move":
+                if record["ply"] <= len(moves):
+                    continue  # Already covered by the snapshot
+                if record["ply"] != len(moves) + 1:
+                    log.warning("Gap in the move log of game %s at ply %d", game_id, record["ply"])
+                    break
+                moves.append(record["move"])
+                white_ms, black_ms = record["white_ms"], record["black_ms"]
+            elif record["op"] == "flag":
+                flagged = record["color"]
+        if time_control is None:
+            return None
+        game = ChessGame.restore(time_control, moves, white_ms, black_ms,
+                                 {"white": chess.WHITE, "black": chess.BLACK}.get(flagged))
+        return game
+
+    def load(self):
+        # Rebuilds every persisted game, keyed by game_id
+        game_ids = set()
+        for name in os.listdir(self.directory):
+            stem, extension = os.path.splitext(name)
+            if extension in (".log", ".snap") and stem.isdigit():
+                game_ids.add(int(stem))
+        games = {}
+        for game_id in sorted(game_ids):
+            try:
+                game = self.load_game(game_id)
+            except (ValueError, KeyError) as e:
+                log.error("Could not recover game %s: %s", game_id, e)
+                continue
+            if game is not None:
+                games[game_id] = game
+        return games
@@ -0,0 +1,25 @@
+from protocol import BINARY, HEADER, MOVE, MOVE_STRUCT, RESYNC
+
+
+def test_truncated_frame_does_not_read_the_next_one():
+    # A RESYNC frame that declares no payload is dropped, the JOIN frame after it decodes intact
+    data = HEADER.pack(0, RESYNC) + BINARY.encode({"game_id": 7})
+    assert BINARY.decoder().feed(data) == [{"game_id": 7}]
+
+
+def test_oversized_frame_is_dropped():
+    data = HEADER.pack(MOVE_STRUCT.size + 1, MOVE) + MOVE_STRUCT.pack(1, 0, 0) + b"\0"
+    data += BINARY.encode({"action": "resync", "game_id": 3})
+    assert BINARY.decoder().feed(data) == [{"action": "resync", "game_id": 3}]
+
+
+def test_frames_split_across_reads():
+    messages = [{"action": "reconnect", "game_id": 3, "color": "black"},
+                {"action": "move", "move": "e7e8q", "game_id": 3, "think_ms": 250},
+                {"action": "chat", "message": "gg"}]
+    data = b"".join(BINARY.encode(message) for message in messages)
+    decoder = BINARY.decoder()
+    decoded = []
+    for start in range(0, len(data), 5):
+        decoded += decoder.feed(data[start:start + 5])
+    assert decoded == messages
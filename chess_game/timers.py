@@ -0,0 +1,47 @@
+import heapq
+import itertools
+
+
+class TimerHeap:
+    # One heap of flag-fall deadlines for every game on the server. Rescheduling or
+    # cancelling a key does not search the heap, stale entries are skipped when they
+    # reach the top (or dropped in bulk once they outnumber the live ones).
+    def __init__(self):
+        self.heap = []  # (deadline, tie breaker, key)
+        self.deadlines = {}  # key: currently scheduled deadline
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key, deadline):
+        if self.deadlines.get(key) == deadline:
+            return
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, next(self.counter), key))
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.compact()
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    def compact(self):
+        self.heap = [entry for entry in self.heap if self.deadlines.get(entry[2]) == entry[0]]
+        heapq.heapify(self.heap)
+
+    def next_deadline(self):
+        while self.heap:
+            deadline, _, key = self.heap[0]
+            if self.deadlines.get(key) == deadline:
+                return deadline
+            heapq.heappop(self.heap)
+        return None
+
+    def pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self.heap)
+            if self.deadlines.get(key) == deadline:
+                del self.deadlines[key]
+                due.append(key)
+        return due